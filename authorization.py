@@ -2,26 +2,141 @@ import os
 import requests
 import json
 import time
+import base64
+import tempfile
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # no locking of token file on Windows
+    fcntl = None
+
+# validity of token without exp claim
+DEFAULT_VALIDITY = 10 * 60 * 60
+
+
+def token_expiry(id_token):
+    '''
+    Returns: time of expiry from exp claim of JWT id_token, None if the token is not JWT
+    '''
+    try:
+        payload = id_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+@contextmanager
+def token_file_lock(token_file):
+    '''
+    Exclusive lock of token file among processes, it is held on token_file.lock
+    '''
+    if token_file is None:
+        yield
+        return
+    with open(token_file + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 
 class Authorization:
-    def __init__(self, host, client_id, username, password, token_file=None):
+    def __init__(self, host, client_id, username, password, token_file=None, client=None, refresh_margin=15 * 60,
+                 retry_delay=30.0, background_refresh=True):
+        '''
+        Source of authorization header. Token is refreshed in background thread refresh_margin seconds
+        before it expires, so requests do not wait for login. Only one login is in flight per process and
+        processes sharing token_file reuse the token of the one which refreshed it first.
+        Args:
+            host (string): url of auth0 login
+            client_id (string): auth0 client
+            username (string):
+            password (string):
+            token_file (string): file where to save/load token, it is locked while token is refreshed
+            client (SpaceKnowClient): shared HTTP client
+            refresh_margin (float): seconds before expiry when token is refreshed, at most half of lifetime
+                of token is used, so short-lived tokens are not refreshed right after login
+            retry_delay (float): seconds between attempts of failed background refresh
+            background_refresh (bool): refresh token by background thread
+        '''
         self.host = host
+        self.client = client
         self.client_id = client_id
         self.username = username
         self.password = password
+        self.token_file = token_file
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self.id_token = None
         self.valid_to = 0.0
-        if token_file is not None:
-            if os.path.isfile(token_file):
-                self.load_token(token_file)
-        if self.valid_to < time.time():
-            self.update_token()
-            if token_file is not None:
-                self.save_token(token_file)
+        self.issued_at = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.refresh()
+        self.thread = None
+        if background_refresh:
+            self.thread = threading.Thread(target=self._run_refresher, name="TokenRefresher", daemon=True)
+            self.thread.start()
 
     def __repr__(self):
         return f"{self.username} valid to {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.valid_to))}"
 
+    @property
+    def margin(self):
+        '''
+        Seconds before expiry when token is refreshed, refresh_margin clamped to half of lifetime of token
+        '''
+        return min(self.refresh_margin, 0.5 * max(0.0, self.valid_to - self.issued_at))
+
+    def needs_refresh(self):
+        return self.id_token is None or self.valid_to - self.margin < time.time()
+
+    def refresh(self):
+        '''
+        Refresh token if it is close to expiry. Concurrent callers wait for the one login in flight,
+        token saved by other process to token_file meanwhile is used instead of a new login.
+        Returns: True if token is fresh
+        '''
+        with self.lock:
+            if not self.needs_refresh():
+                return True
+            with token_file_lock(self.token_file):
+                if self.token_file is not None:
+                    self.load_token(self.token_file)
+                if self.needs_refresh() and self.update_token() and self.token_file is not None:
+                    self.save_token(self.token_file)
+            return not self.needs_refresh()
+
+    def close(self):
+        '''
+        Stop background refresh
+        '''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run_refresher(self):
+        while not self.stopped.is_set():
+            delay = self.valid_to - self.margin - time.time()
+            if delay <= 0:
+                valid_to = self.valid_to
+                if self.refresh() or self.valid_to > valid_to:
+                    # new token, the next refresh is planned from its expiry
+                    continue
+                delay = self.retry_delay
+            self.stopped.wait(delay)
+
     def update_token(self):
+        '''
+        Login to auth0
+        Returns: True if new token was obtained
+        '''
         login_data = {
             "client_id": self.client_id,
             "username": self.username,
@@ -30,34 +145,65 @@ class Authorization:
             "grant_type": "password",
             "scope": "openid"
         }
-        r = requests.post(self.host, data=login_data)
+        try:
+            if self.client is not None:
+                # session of the client, authorization header of the client must not be needed for login
+                r = self.client.session.post(self.host, data=login_data, timeout=self.client.timeout)
+            else:
+                r = requests.post(self.host, data=login_data, timeout=60)
+        except requests.RequestException as e:
+            print(e)
+            return False
         if r.status_code == 200:
             jsondata = r.json()
             self.id_token = jsondata.get("id_token")
-            self.valid_to = time.time() + 10 * 60 * 60  # current time plus 10 hours
+            self.issued_at = time.time()
+            expiry = token_expiry(self.id_token)
+            self.valid_to = expiry if expiry is not None else time.time() + DEFAULT_VALIDITY
+            return True
         else:
             print(r.status_code)
             print(r.headers['content-type'])
             print(r.encoding)
             print(r.text)
+            return False
 
     def save_token(self, token_file):
+        '''
+        Save token atomically, readers never see partially written file
+        '''
         file_data = {
             "id_token": self.id_token,
             "valid_to": self.valid_to,
+            "issued_at": self.issued_at,
         }
-        json.dump(file_data, open(token_file, "w"))
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(token_file)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(file_data, f)
+        os.replace(temp_path, token_file)
 
     def load_token(self, token_file):
+        '''
+        Load token from file if it is valid longer than the current one
+        '''
         if os.path.isfile(token_file):
-            file_data = json.load(open(token_file))
-            self.id_token = file_data["id_token"]
-            self.valid_to = file_data["valid_to"]
+            try:
+                file_data = json.load(open(token_file))
+            except ValueError:
+                return
+            if file_data.get("id_token") is not None and file_data.get("valid_to", 0.0) > self.valid_to:
+                self.id_token = file_data["id_token"]
+                self.valid_to = file_data["valid_to"]
+                # file of older version has no issued_at, lifetime is counted from now
+                self.issued_at = file_data.get("issued_at", min(time.time(), self.valid_to))
 
     def headers(self):
-        rest_of_time = self.valid_to - time.time()
-        if rest_of_time < 0:
-            self.update_token()
+        if self.valid_to < time.time():
+            # token already expired (background refresh failed or is disabled), request has to wait for login
+            self.refresh()
+        elif self.thread is None and self.needs_refresh() and not self.lock.locked():
+            # no background refresh, start one so that this request does not wait
+            threading.Thread(target=self.refresh, name="TokenRefresher", daemon=True).start()
         headers = {
             'Content-Type': 'application/json',
             'Authorization': 'Bearer {}'.format(self.id_token),
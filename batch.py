@@ -0,0 +1,281 @@
+import os
+import glob
+import geojson
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ragnar import SearchScene
+from kraken import Kraken
+from task_in_progress import StatusPoller
+from spaceknow_tools import EPSGTransformator, TileFetcher, geometry_bounds, bounds_to_geometry, to_pixels
+from pipeline import initiate_job, finish_job, guarded, render_features, make_getimage, scene_key
+from clipping import ExtentClipper
+
+
+def load_extents(paths):
+    '''
+    Load extents from GeoJSON files, directories are searched for *.geojson files
+    Args:
+        paths (list of string): GeoJSON files or directories
+    Returns: dict name of extent (file name without extension) -> extent
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.geojson"))))
+        else:
+            files.append(path)
+    extents = {}
+    for file in files:
+        name = os.path.splitext(os.path.basename(file))[0]
+        extents[name] = geojson.load(open(file))
+    return extents
+
+def bounds_intersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def bounds_gap(a, b):
+    '''
+    Distance between two bounding boxes, 0 if they intersect
+    '''
+    dx = max(0.0, max(a[0], b[0]) - min(a[2], b[2]))
+    dy = max(0.0, max(a[1], b[1]) - min(a[3], b[3]))
+    return max(dx, dy)
+
+def cluster_extents(extents, max_gap=0.01):
+    '''
+    Merge extents whose bounding boxes are closer than max_gap into regions
+    Args:
+        extents (dict): name -> extent
+        max_gap (float): maximal distance of bounding boxes in degrees to merge them
+    Returns: list of tuples (bounds of region, list of names of extents)
+    '''
+    regions = [(geometry_bounds(extent), [name]) for name, extent in extents.items()]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                (a, names_a), (b, names_b) = regions[i], regions[j]
+                if bounds_gap(a, b) <= max_gap:
+                    bounds = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    regions[i] = (bounds, names_a + names_b)
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+def detections_in_bounds(detections, bounds):
+    '''
+    Detections whose centre of bounding box lies in bounds
+    Args:
+        detections (DetectionStore):
+        bounds (tuple): minx, miny, maxx, maxy
+    Returns: DetectionStore
+    '''
+    fb = detections.bounds()
+    cx = (fb[:, 0] + fb[:, 2]) / 2
+    cy = (fb[:, 1] + fb[:, 3]) / 2
+    inside = (cx >= bounds[0]) & (cx <= bounds[2]) & (cy >= bounds[1]) & (cy <= bounds[3])
+    return detections.select(inside)
+
+def crop_to_bounds(rgb_image, band, bounds, crsEpsg):
+    '''
+    Crop image to bounding box given in WGS84
+    Args:
+        rgb_image (np.array): image
+        band (dict): band from meta of GetImage with crsOriginX/Y and pixelSizeX/Y of rgb_image
+        bounds (tuple): minx, miny, maxx, maxy in WGS84
+        crsEpsg (int): crs of image
+    Returns: tuple (cropped copy of image, band with origin of cropped image)
+    '''
+    minx, miny, maxx, maxy = bounds
+    corners = np.array([[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy]])
+    corners = EPSGTransformator(crsEpsg).transform_array(corners)
+    pixels = to_pixels(corners, (band["crsOriginX"], band["crsOriginY"]), (band["pixelSizeX"], band["pixelSizeY"]))
+    height, width = rgb_image.shape[:2]
+    if not np.isfinite(pixels).all():
+        # crs of scene can not represent bounds, keep whole image
+        return rgb_image.copy(), band
+    col0, row0 = np.clip(np.floor(pixels.min(axis=0)).astype(int), 0, (width, height))
+    col1, row1 = np.clip(np.ceil(pixels.max(axis=0)).astype(int), 0, (width, height))
+    cropped_band = dict(band)
+    cropped_band["crsOriginX"] = band["crsOriginX"] + col0 * band["pixelSizeX"]
+    cropped_band["crsOriginY"] = band["crsOriginY"] + row0 * band["pixelSizeY"]
+    return rgb_image[row0:row1, col0:col1].copy(), cropped_band
+
+
+def run_batch(extents, satellite_imagery, headers, max_gap=0.01, max_concurrency=8, max_polls_per_second=5.0,
+              tile_fetcher=None, cache=None, client=None, image_tile_size=None, streaming=False, mmap_dir=None,
+              journal=None, planner=None,
+              dry_run=False, map_types=("cars",), writer=None,
+              timeseries=None, clip="centroid", densities=None, images=True):
+    '''
+    Process many extents together. Near extents are merged to regions, each region is searched once
+    and Kraken of each map type and GetImage run once per scene and region. Results are clipped to each extent.
+    Args:
+        extents (dict): name -> extent, see load_extents
+        satellite_imagery (SatelliteImagery): provider and dataset
+        headers (dict): headers with authorization
+        max_gap (float): maximal distance of extents in degrees to merge them to one region
+        max_concurrency (int): maximal number of jobs polled and retrieved at once, all jobs are initiated up front
+        max_polls_per_second (float): maximal rate of status requests of all jobs together
+        tile_fetcher (TileFetcher): downloader of detection tiles
+        cache (DiskCache): cache of search results, Kraken results and images
+        client (SpaceKnowClient): shared HTTP client
+        image_tile_size (int): if set, images are requested in tiles of this size in pixels
+        streaming (bool): spool *.ski files to disk and decode bands lazily
+        mmap_dir (string): directory where bands of images are decoded into memory-mapped files
+        journal (PipelineJournal): journal of pipelines and outputs, finished outputs are skipped
+        planner (ScenePlanner): filter of scenes of each region
+        dry_run (bool): only print which scenes would be processed
+        map_types (list of string): map types of Kraken, detections of all of them are drawn to one image
+        writer (ImageWriter): writer of images in background, images are written synchronously if None
+        timeseries (TimeSeriesStore): store of processed scenes of each extent, regions are searched
+            from the earliest watermark of their extents and only new scenes of each extent are processed
+        clip (string): detections outside each extent are dropped, see modes of ExtentClipper,
+            None keeps detections with centre of bounding box in bounding box of extent
+        densities (dict): name of extent -> DensityGrid to which detections of each scene are added
+        images (bool): run GetImage and save image of each scene and extent, only detections are retrieved if False
+    Returns: dict name of extent -> list of tuples (name of image file, dict map type -> number of detections),
+        name of image file is None if images is False
+    '''
+    if tile_fetcher is None:
+        tile_fetcher = TileFetcher(session=client, cache=cache)
+    extent_bounds = {name: geometry_bounds(extent) for name, extent in extents.items()}
+    clippers = {name: ExtentClipper(extent, clip) for name, extent in extents.items()} if clip is not None else None
+    regions = cluster_extents(extents, max_gap)
+    print(f"{len(extents)} extents merged to {len(regions)} regions")
+    results = {name: [] for name in extents}
+
+    def plan_region(search, region_extent, names):
+        '''
+        Jobs of scenes found by search of region
+        Returns: list of tuples (list of jobs of scene, (metadata, covered extents, krakens, getimage, stored files))
+        '''
+        if search.status != "RESOLVED":
+            print(f"Search of {', '.join(names)} is {search.status}")
+            return []
+        scenes = search.results
+        if planner is not None:
+            scenes, rejected = planner.plan(scenes, region_extent)
+            print(f"Region of {', '.join(names)}:")
+            planner.report(scenes, rejected)
+        if dry_run:
+            return []
+        planned = []
+        for metadata in scenes:
+            footprint_bounds = geometry_bounds(metadata.footprint)
+            covered = [name for name in names
+                       if footprint_bounds is None or bounds_intersect(footprint_bounds, extent_bounds[name])]
+            if timeseries is not None:
+                covered = [name for name in covered if not timeseries.is_done(extents[name], metadata, map_types)]
+            # extents whose image is in journal are not rendered again, only recorded to timeseries
+            stored_files = {}
+            if images and journal is not None:
+                for name in covered:
+                    output = journal.output(scene_key(metadata, extents[name], map_types))
+                    if output is not None:
+                        print(f"Scene {metadata.sceneId} of {name} is already done")
+                        results[name].append((output, None))
+                        stored_files[name] = output
+                if timeseries is None:
+                    covered = [name for name in covered if name not in stored_files]
+            if not covered:
+                continue
+            krakens = {map_type: Kraken(metadata.sceneId, region_extent, map_type, headers,
+                                        tile_fetcher=tile_fetcher, cache=cache, client=client, keep_features=False)
+                       for map_type in map_types}
+            getimage = None
+            if images and any(name not in stored_files for name in covered):
+                getimage = make_getimage(metadata, region_extent, headers, cache, client, image_tile_size,
+                                         streaming, mmap_dir)
+            scene_jobs = ([getimage] if getimage is not None else []) + list(krakens.values())
+            planned.append((scene_jobs, (metadata, covered, krakens, getimage, stored_files)))
+        print(f"{sum(len(scene_jobs) for scene_jobs, _ in planned)} jobs for {len(planned)} scenes "
+              f"of {', '.join(names)}")
+        return planned
+
+    def finish_scene(metadata, covered, krakens, getimage, stored_files):
+        '''
+        Clip detections of scene to its extents, render and record them
+        '''
+        if ((getimage is not None and getimage.status != "RESOLVED")
+                or any(kraken.status != "RESOLVED" for kraken in krakens.values())):
+            statuses = ", ".join(f"Kraken {map_type} is {kraken.status}" for map_type, kraken in krakens.items())
+            if getimage is not None:
+                statuses += f", GetImage is {getimage.status}"
+            print(f"Scene {metadata.sceneId} skipped, {statuses}")
+            if timeseries is not None:
+                for name in covered:
+                    timeseries.record_failure(extents[name], metadata)
+            if getimage is not None:
+                getimage.close()
+            return
+        for name in covered:
+            if clippers is not None:
+                detections = {map_type: clippers[name].clip(kraken.detections)
+                              for map_type, kraken in krakens.items()}
+            else:
+                detections = {map_type: detections_in_bounds(kraken.detections, extent_bounds[name])
+                              for map_type, kraken in krakens.items()}
+            img_file = stored_files.get(name)
+            if img_file is None and getimage is not None:
+                rgb_image, band = crop_to_bounds(getimage.skimage.imageRGB, getimage.meta["bands"][0],
+                                                 extent_bounds[name], metadata.crsEpsg)
+                img_file = render_features(metadata, detections, rgb_image, band, img_prefix=name + "_",
+                                           writer=writer)
+                if journal is not None:
+                    journal.record_output(scene_key(metadata, extents[name], map_types), img_file)
+            if densities is not None:
+                densities[name].add(metadata, detections)
+            counts = {map_type: len(store) for map_type, store in detections.items()}
+            if name not in stored_files:
+                for map_type, count in counts.items():
+                    print(f"Number of {map_type} in {name} is {count}")
+                results[name].append((img_file, counts))
+            if timeseries is not None:
+                timeseries.record(extents[name], metadata, detections, img_file, name)
+        if getimage is not None:
+            getimage.close()
+
+    # pipelines are initiated by their own pool as soon as their jobs exist, so initiations never wait behind
+    # jobs which are polled, only waiting for jobs and retrieving their results is limited by max_concurrency
+    with StatusPoller(max_polls_per_second) as poller, ThreadPoolExecutor(max_workers=max_concurrency) as initiator, \
+            ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        # future -> (True if it initiates the job, region or scene of the job)
+        pending = {}
+        for bounds, names in regions:
+            region_extent = bounds_to_geometry(bounds)
+            if timeseries is None:
+                search = SearchScene(satellite_imagery, region_extent, headers=headers, cache=cache, client=client)
+            else:
+                for name in names:
+                    timeseries.state(extents[name], name)
+                watermarks = [timeseries.watermark(extents[name], map_types) for name in names]
+                startDatetime = None if None in watermarks else min(watermarks)
+                if planner is not None:
+                    startDatetime = planner.search_start(startDatetime)
+                search = SearchScene(satellite_imagery, region_extent, startDatetime=startDatetime, headers=headers,
+                                     client=client)
+            pending[initiator.submit(guarded, initiate_job, search, journal)] = (True, (region_extent, names))
+
+        remaining = {}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                initiated, context = pending.pop(future)
+                job = future.result()
+                if initiated:
+                    pending[executor.submit(guarded, finish_job, job, poller, journal)] = (False, context)
+                elif isinstance(job, SearchScene):
+                    for scene_jobs, scene in plan_region(job, *context):
+                        remaining[id(scene[2])] = len(scene_jobs)
+                        for scene_job in scene_jobs:
+                            pending[initiator.submit(guarded, initiate_job, scene_job, journal)] = (True, scene)
+                else:
+                    remaining[id(context[2])] -= 1
+                    if remaining[id(context[2])] == 0:
+                        finish_scene(*context)
+    return results
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+import multiprocessing
+import geojson
+from fake_server import FakeSpaceKnow, use_server
+
+# sizes of extent, image_size is width and height of scene in pixels
+SIZES = {
+    "small": {"image_size": 512, "tiles_per_scene": 4},
+    "medium": {"image_size": 1536, "tiles_per_scene": 16},
+    "large": {"image_size": 3072, "tiles_per_scene": 64},
+}
+
+
+class StageTimer:
+    def __init__(self):
+        '''
+        Wall time of pipeline stages, measured by wrapping functions of the client
+        '''
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, start, end, nbytes=0):
+        with self.lock:
+            s = self.stages.setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0, "bytes": 0,
+                                               "first_start": start, "last_end": end})
+            s["count"] += 1
+            s["total"] += end - start
+            s["max"] = max(s["max"], end - start)
+            s["bytes"] += nbytes
+            s["first_start"] = min(s["first_start"], start)
+            s["last_end"] = max(s["last_end"], end)
+
+    def wrap(self, stage, function, nbytes=None):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            ret = function(*args, **kwargs)
+            self.add(stage(*args) if callable(stage) else stage, start, time.perf_counter(),
+                     nbytes(ret) if nbytes is not None else 0)
+            return ret
+        return wrapper
+
+    def install(self):
+        import pipeline
+        import ragnar
+        import spaceknow_tools
+        # jobs are initiated up front, stage of job is waiting for it and retrieving its result
+        pipeline.finish_job = self.wrap(lambda job, *args: type(job).__name__, pipeline.finish_job)
+        pipeline.render_scene = self.wrap("render", pipeline.render_scene)
+        spaceknow_tools.DetectionTile.download = self.wrap("tile", spaceknow_tools.DetectionTile.download, len)
+        parse = ragnar.SKImage.__dict__["parse_skband_file"].__func__
+        ragnar.SKImage.parse_skband_file = classmethod(self.wrap("decode", parse, lambda a: a.nbytes))
+
+    def report(self):
+        ret = {}
+        for stage, s in self.stages.items():
+            ret[stage] = {
+                "count": s["count"],
+                "mean_s": s["total"] / s["count"],
+                "max_s": s["max"],
+                "window_s": s["last_end"] - s["first_start"],
+                "total_s": s["total"],
+                "bytes": s["bytes"],
+            }
+        return ret
+
+
+def run_pipeline(url, geojson_file, max_concurrency, tile_workers):
+    '''
+    Equivalent of main.py against server at url, it is run in a fresh process to measure peak RSS
+    Returns: dict with results
+    '''
+    use_server(url)
+    import pipeline
+    from authorization import Authorization
+    from http_client import SpaceKnowClient
+    from ragnar import SearchScene
+    from spaceknow_tools import SatelliteImagery, TileFetcher
+    from metrics import metrics
+
+    extent = geojson.load(open(geojson_file))
+    os.chdir(tempfile.mkdtemp(prefix="benchmark"))
+    timer = StageTimer()
+    timer.install()
+
+    start = time.perf_counter()
+    client = SpaceKnowClient(api_hosts=[urlparse(url).hostname])
+    auth = Authorization(url + "/oauth/ro", "benchmark", "benchmark", "benchmark", client=client)
+    client.auth = auth
+    search_start = time.perf_counter()
+    search = SearchScene(SatelliteImagery("gbdx", "idaho-pansharpened"), extent, client=client)
+    search.initiate()
+    search.wait_till_job_is_done()
+    search.retrieve()
+    timer.add("search", search_start, time.perf_counter())
+    img_files = pipeline.run_scenes(search.results, extent, auth.headers(), max_concurrency=max_concurrency,
+                                    tile_fetcher=TileFetcher(workers=tile_workers, session=client), client=client)
+    wall = time.perf_counter() - start
+
+    stages = timer.report()
+    tile = stages.get("tile", {})
+    decode = stages.get("decode", {})
+    return {
+        "wall_s": wall,
+        "scenes": len(img_files),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "scenes_per_min": len(img_files) / wall * 60,
+        "tiles_per_s": tile["count"] / tile["window_s"] if tile.get("window_s") else 0.0,
+        "decoded_mb_per_s": decode["bytes"] / 1024 ** 2 / decode["total_s"] if decode.get("total_s") else 0.0,
+        "stages": stages,
+        "metrics": metrics.to_dict(),
+    }
+
+
+def run_benchmark(size, geojson_file, job_latency=1.0, num_scenes=4, features_per_tile=50, failure_rate=0.0,
+                  max_concurrency=8, tile_workers=16):
+    fake = FakeSpaceKnow(job_latency=job_latency, num_scenes=num_scenes, features_per_tile=features_per_tile,
+                         failure_rate=failure_rate, **SIZES[size])
+    with fake:
+        # generate image before the measurement
+        fake.image()
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_pipeline, fake.url, geojson_file, max_concurrency, tile_workers).result()
+    result["size"] = size
+    result["requests"] = dict(fake.request_counts)
+    return result
+
+
+def print_result(result):
+    print(f"{result['size']}: wall={result['wall_s']:.2f}s scenes={result['scenes']} "
+          f"peak RSS={result['peak_rss_mb']:.0f} MB {result['scenes_per_min']:.1f} scenes/min "
+          f"{result['tiles_per_s']:.1f} tiles/s {result['decoded_mb_per_s']:.1f} MB decoded/s")
+    for stage, s in sorted(result["stages"].items()):
+        print(f"    {stage:12s} n={s['count']:<5d} mean={s['mean_s'] * 1000:8.1f} ms max={s['max_s'] * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-g", "--geojson", help="GeoJSON file with extent", default=os.path.join("Extent", "dickson_rd.geojson"))
+    ap.add_argument("-s", "--sizes", help="sizes of extent", nargs="+", choices=list(SIZES), default=list(SIZES))
+    ap.add_argument("--scenes", help="number of scenes returned by search", type=int, default=4)
+    ap.add_argument("--job-latency", help="seconds till a pipeline is RESOLVED", type=float, default=1.0)
+    ap.add_argument("--features-per-tile", help="number of detections in one tile", type=int, default=50)
+    ap.add_argument("--failure-rate", help="probability of 503 response", type=float, default=0.0)
+    ap.add_argument("--max-concurrency", help="maximal number of jobs in flight", type=int, default=8)
+    ap.add_argument("--tile-workers", help="number of detection tiles downloaded at once", type=int, default=16)
+    ap.add_argument("-o", "--output", help="JSON file with results", default=None)
+    args = vars(ap.parse_args())
+
+    geojson_file = os.path.abspath(args["geojson"])
+    results = []
+    for size in args["sizes"]:
+        result = run_benchmark(size, geojson_file, job_latency=args["job_latency"], num_scenes=args["scenes"],
+                               features_per_tile=args["features_per_tile"], failure_rate=args["failure_rate"],
+                               max_concurrency=args["max_concurrency"], tile_workers=args["tile_workers"])
+        print_result(result)
+        results.append(result)
+    if args["output"] is not None:
+        json.dump(results, open(args["output"], "w"), indent=2)
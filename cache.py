@@ -0,0 +1,161 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+
+def hash_key(*parts):
+    '''
+    Key of cache entry, sha256 of parts serialized to json
+    Args:
+        parts: json-serializable objects, e.g. sceneId, extent, resolution
+    Returns: hex string
+    '''
+    data = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def search_key(satellite_imagery, extent, startDatetime=None, endDatetime=None, minIntersection=None):
+    return hash_key("search", satellite_imagery.provider, satellite_imagery.dataset, extent,
+                    startDatetime, endDatetime, minIntersection)
+
+def kraken_key(sceneId, extent, map_type):
+    return hash_key("kraken", sceneId, extent, map_type)
+
+def tile_key(mapId, geometryId, zoom, x, y):
+    return hash_key("tile", mapId, geometryId, zoom, x, y)
+
+def image_key(sceneId, extent, resolution=None):
+    return hash_key("image", sceneId, extent, resolution)
+
+def image_meta_key(key):
+    return hash_key("image-meta", key)
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3):
+        '''
+        Persistent content-addressed cache. Entries are files, writes are atomic (temporary file
+        and rename), so the cache can be shared by concurrent workers. The least recently used
+        entries are evicted when size of cache exceeds max_bytes.
+        Args:
+            directory (string): directory of cache, it is created if it does not exist
+            max_bytes (int): maximal size of cache in bytes
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    def __repr__(self):
+        return f"DiskCache {self.directory} {self.size / 1024 ** 2:.1f} MB, hits={self.hits}, misses={self.misses}"
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def open(self, key):
+        '''
+        Returns: opened binary file of entry or None if there is no such entry
+        '''
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            # mtime is time of last use
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return f
+
+    def get(self, key):
+        '''
+        Returns: bytes of entry or None if there is no such entry
+        '''
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def get_json(self, key):
+        data = self.get(key)
+        return None if data is None else json.loads(data)
+
+    def put(self, key, data):
+        '''
+        Store bytes under key
+        '''
+        with self._writer(key) as f:
+            f.write(data)
+
+    def put_json(self, key, obj):
+        self.put(key, json.dumps(obj).encode("utf-8"))
+
+    def put_file(self, key, fileobj, chunk_size=1024 * 1024):
+        '''
+        Store content of file under key, it is copied in chunks
+        '''
+        with self._writer(key) as f:
+            shutil.copyfileobj(fileobj, f, chunk_size)
+
+    def _writer(self, key):
+        return _AtomicWriter(self, key)
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith("."):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                yield os.path.join(root, name), stat.st_mtime, stat.st_size
+
+    def _added(self, size):
+        with self.lock:
+            self.size += size
+            if self.size <= self.max_bytes:
+                return
+            # evict the least recently used entries down to 90% of max_bytes
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            self.size = sum(size for _, _, size in entries)
+            for path, _, size in entries:
+                if self.size <= 0.9 * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.size -= size
+
+
+class _AtomicWriter:
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.path = cache.path(key)
+
+    def __enter__(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is not None:
+            os.remove(self.temp_path)
+            return
+        size = os.path.getsize(self.temp_path)
+        os.replace(self.temp_path, self.path)
+        self.cache._added(size)
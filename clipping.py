@@ -0,0 +1,90 @@
+import numpy as np
+import cv2
+from spaceknow_tools import geometry_bounds, geometry_polygons
+from detections import DetectionStore
+
+MODES = ["centroid", "any", "all"]
+
+
+class ExtentClipper:
+    def __init__(self, extent, mode="centroid", max_mask_size=4096):
+        '''
+        Keep only detections inside extent. Extent is rasterized once to a mask over its bounding box,
+        points are tested by bounding box and then by one lookup to the mask.
+        Args:
+            extent (object): GeoJSON geometry (e.g. GeometryCollection from Extent/), holes of polygons are respected
+            mode (string): which detections are inside, centroid: their centroid is inside,
+                any: any of their points is inside (partial overlap is kept), all: all their points are inside
+            max_mask_size (int): size of longer side of mask in pixels, it gives precision of the test
+        '''
+        assert mode in MODES
+        self.mode = mode
+        self.bounds = geometry_bounds(extent)
+        if self.bounds is None:
+            raise ValueError("Extent has no points")
+        minx, miny, maxx, maxy = self.bounds
+        self.pixel_size = max(maxx - minx, maxy - miny, 1e-12) / max_mask_size
+        width = int(np.ceil((maxx - minx) / self.pixel_size)) + 1
+        height = int(np.ceil((maxy - miny) / self.pixel_size)) + 1
+        self.mask = np.zeros((height, width), dtype=np.uint8)
+        # coordinates with 8 fractional bits, see shift of cv2.fillPoly
+        scale = 256.0 / self.pixel_size
+        polygons = list(geometry_polygons(extent))
+        for value, rings in ((1, [polygon[:1] for polygon in polygons]), (0, [polygon[1:] for polygon in polygons])):
+            contours = [np.round((np.array(ring, dtype=np.float64)[:, :2] - (minx, miny)) * scale).astype(np.int32)
+                        for polygon_rings in rings for ring in polygon_rings if len(ring) > 0]
+            if contours:
+                cv2.fillPoly(self.mask, contours, value, lineType=cv2.LINE_8, shift=8)
+
+    def __repr__(self):
+        return f"ExtentClipper {self.mode} mask={self.mask.shape[1]}x{self.mask.shape[0]}"
+
+    def contains(self, points):
+        '''
+        Args:
+            points (np.array): shape (N, 2), x and y (longitude and latitude) of points
+        Returns: bool np.array with shape (N,)
+        '''
+        minx, miny, maxx, maxy = self.bounds
+        x, y = points[:, 0], points[:, 1]
+        inside = (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)
+        candidates = np.flatnonzero(inside)
+        cols = np.minimum(((x[candidates] - minx) / self.pixel_size).astype(np.int64), self.mask.shape[1] - 1)
+        rows = np.minimum(((y[candidates] - miny) / self.pixel_size).astype(np.int64), self.mask.shape[0] - 1)
+        inside[candidates] = self.mask[rows, cols] > 0
+        return inside
+
+    def select(self, detections):
+        '''
+        Args:
+            detections (DetectionStore): detections in the crs of extent
+        Returns: bool np.array, True for detections inside extent
+        '''
+        if self.mode == "centroid":
+            centroids = detections.centroids()
+            # features without points have nan centroid, comparisons of nan are False
+            return self.contains(centroids)
+        feature_rings = detections.feature_rings()
+        point_offsets = detections.ring_offsets[feature_rings]
+        inside = self.contains(detections.coordinates)
+        nonempty = np.diff(point_offsets) > 0
+        selected = np.zeros(len(point_offsets) - 1, dtype=bool)
+        if nonempty.any():
+            reduce = np.logical_or if self.mode == "any" else np.logical_and
+            selected[nonempty] = reduce.reduceat(inside, point_offsets[:-1][nonempty])
+        return selected
+
+    def clip(self, detections):
+        '''
+        Returns: DetectionStore with detections inside extent
+        '''
+        return detections.select(self.select(detections))
+
+    def clip_features(self, features):
+        '''
+        Returns: list of features inside extent
+        '''
+        if not features:
+            return features
+        selected = self.select(DetectionStore.from_features(features))
+        return [feature for feature, keep in zip(features, selected) if keep]
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+import cv2
+from spaceknow_tools import EPSGTransformator, geometry_points
+from planner import parse_datetime, time_bucket
+from image_writer import write_image
+
+
+def utm_epsg(lon, lat):
+    '''
+    EPSG code of WGS84 / UTM zone of point
+    '''
+    zone = min(int((lon + 180.0) // 6.0) + 1, 60)
+    return (32600 if lat >= 0 else 32700) + zone
+
+
+class DensityGrid:
+    def __init__(self, extent, cell_size=10.0, crsEpsg=None, period="month"):
+        '''
+        Counts of detections in cells of a fixed grid over extent, one grid for each time period.
+        Centroids of detections of each scene are projected and binned by one histogram, so the grid
+        is updated as scenes arrive and is much smaller than the images of scenes.
+        Args:
+            extent (object): GeoJSON geometry, the grid covers its bounding box in crsEpsg
+            cell_size (float): size of cell in units of crsEpsg (metres of UTM)
+            crsEpsg (int): projected crs of the grid, UTM zone of centre of extent if None
+            period (string): day, week, month or year, see planner.BUCKETS
+        '''
+        points = np.asarray(list(geometry_points(extent)), dtype=np.float64)[:, :2]
+        if crsEpsg is None:
+            crsEpsg = utm_epsg(*points.mean(axis=0))
+        projected = EPSGTransformator(crsEpsg).transform_array(points)
+        self.crsEpsg = crsEpsg
+        self.cell_size = cell_size
+        self.period = period
+        # grid is aligned to multiples of cell_size, origin is its upper left corner
+        self.originX = np.floor(projected[:, 0].min() / cell_size) * cell_size
+        self.originY = np.ceil(projected[:, 1].max() / cell_size) * cell_size
+        self.width = max(1, int(np.ceil((projected[:, 0].max() - self.originX) / cell_size)))
+        self.height = max(1, int(np.ceil((self.originY - projected[:, 1].min()) / cell_size)))
+        self.counts = {}
+        self.scenes = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"DensityGrid EPSG:{self.crsEpsg} {self.width}x{self.height} cells of {self.cell_size} "
+                f"periods={len(self.counts)}")
+
+    @property
+    def band(self):
+        '''
+        Georeferencing of rasters in the form of band of GetImage, see image_writer.georeference
+        '''
+        return {"crsOriginX": self.originX, "crsOriginY": self.originY,
+                "pixelSizeX": self.cell_size, "pixelSizeY": -self.cell_size}
+
+    def histogram(self, detections):
+        '''
+        Args:
+            detections (DetectionStore): detections in WGS84
+        Returns: np.array (height, width) with number of centroids in each cell
+        '''
+        centroids = detections.centroids()
+        centroids = centroids[np.isfinite(centroids).all(axis=1)]
+        projected = EPSGTransformator(self.crsEpsg).transform_array(centroids)
+        cols = np.floor((projected[:, 0] - self.originX) / self.cell_size).astype(np.int64)
+        rows = np.floor((self.originY - projected[:, 1]) / self.cell_size).astype(np.int64)
+        inside = (cols >= 0) & (cols < self.width) & (rows >= 0) & (rows < self.height)
+        cells = rows[inside] * self.width + cols[inside]
+        return np.bincount(cells, minlength=self.width * self.height).reshape(self.height, self.width)
+
+    def add(self, metadata, detections):
+        '''
+        Add detections of scene to grid of its period, scene which was already added is skipped
+        Args:
+            metadata (Metadata): scene
+            detections (dict): map type -> DetectionStore in WGS84, all map types are counted together
+        Returns: period of scene
+        '''
+        period = time_bucket(parse_datetime(metadata.datetime), self.period)
+        histogram = sum(self.histogram(store) for store in detections.values())
+        with self.lock:
+            scenes = self.scenes.setdefault(period, [])
+            if metadata.sceneId in scenes:
+                return period
+            scenes.append(metadata.sceneId)
+            if period not in self.counts:
+                self.counts[period] = np.zeros((self.height, self.width), dtype=np.uint32)
+            self.counts[period] += histogram.astype(np.uint32)
+        return period
+
+    def density(self, period):
+        '''
+        Returns: np.array (height, width) of float32, mean number of detections per scene in each cell
+        '''
+        with self.lock:
+            return self.counts[period].astype(np.float32) / max(1, len(self.scenes[period]))
+
+    def overlay(self, period, colormap=cv2.COLORMAP_JET, max_density=None):
+        '''
+        Colour-mapped density, cells without detections are transparent
+        Args:
+            max_density (float): density of the hottest colour, 99th percentile of non-empty cells if None
+        Returns: BGRA np.array (height, width, 4) of uint8
+        '''
+        density = self.density(period)
+        nonzero = density > 0
+        if max_density is None:
+            max_density = np.percentile(density[nonzero], 99) if nonzero.any() else 1.0
+        scaled = np.clip(density * (255.0 / max(max_density, 1e-12)), 0, 255).astype(np.uint8)
+        overlay = cv2.cvtColor(cv2.applyColorMap(scaled, colormap), cv2.COLOR_BGR2BGRA)
+        overlay[..., 3] = np.where(nonzero, 255, 0)
+        return overlay
+
+    def save_rasters(self, directory, prefix=""):
+        '''
+        Write density (*.npy) and its overlay (*.png) of each period with world files and JSON sidecars
+        Returns: list of names of written files
+        '''
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for period in sorted(self.counts):
+            base = os.path.join(directory, re.sub('[^-a-zA-Z0-9_.]+', '_', prefix + period))
+            write_image(base + ".npy", self.density(period), "npy", band=self.band, crsEpsg=self.crsEpsg)
+            write_image(base + ".png", self.overlay(period), "png", band=self.band, crsEpsg=self.crsEpsg)
+            files += [base + ".npy", base + ".png"]
+        return files
+
+    def save(self, path):
+        '''
+        Save counts and scenes of all periods, the grid can be loaded and updated by the next run
+        '''
+        meta = {"crsEpsg": self.crsEpsg, "cell_size": self.cell_size, "period": self.period,
+                "originX": self.originX, "originY": self.originY, "width": self.width, "height": self.height,
+                "scenes": self.scenes}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.lock:
+            arrays = {"counts_" + period: counts for period, counts in self.counts.items()}
+        np.savez_compressed(path, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            grid = cls.__new__(cls)
+            for name in ("crsEpsg", "cell_size", "period", "originX", "originY", "width", "height", "scenes"):
+                setattr(grid, name, meta[name])
+            grid.counts = {name[len("counts_"):]: data[name] for name in data.files if name.startswith("counts_")}
+            grid.lock = threading.Lock()
+        return grid
+
+    @classmethod
+    def open(cls, path, extent, cell_size=10.0, crsEpsg=None, period="month"):
+        '''
+        Load grid saved by the previous run or create new one if path does not exist
+        Raises: ValueError if the saved grid has different cell_size, period or crsEpsg
+        '''
+        if not os.path.isfile(path):
+            return cls(extent, cell_size=cell_size, crsEpsg=crsEpsg, period=period)
+        grid = cls.load(path)
+        differences = [f"{name} {saved} (requested {requested})"
+                       for name, saved, requested in (("cell size", grid.cell_size, cell_size),
+                                                      ("period", grid.period, period),
+                                                      ("crs", grid.crsEpsg, crsEpsg if crsEpsg is not None else grid.crsEpsg))
+                       if saved != requested]
+        if differences:
+            raise ValueError(f"Density grid {path} has {', '.join(differences)}")
+        return grid
@@ -0,0 +1,277 @@
+import json
+import numpy as np
+import geojson
+from spaceknow_tools import draw_polygons
+
+
+class DetectionStore:
+    def __init__(self, coordinates=None, ring_offsets=None, polygon_offsets=None, feature_offsets=None,
+                 properties=None):
+        '''
+        Columnar container of Polygon/MultiPolygon detections. Points of i-th ring are
+        coordinates[ring_offsets[i]:ring_offsets[i+1]], rings of j-th polygon are
+        ring_offsets[polygon_offsets[j]:polygon_offsets[j+1]] and polygons of k-th feature
+        are polygon_offsets[feature_offsets[k]:feature_offsets[k+1]].
+        Args:
+            coordinates (np.array): float64 array with shape (N, 2)
+            ring_offsets (np.array): int64 array with shape (num_rings + 1,)
+            polygon_offsets (np.array): int64 array with shape (num_polygons + 1,)
+            feature_offsets (np.array): int64 array with shape (num_features + 1,)
+            properties (dict): name -> np.array with value of property of each feature
+        '''
+        self.coordinates = np.empty((0, 2)) if coordinates is None else coordinates
+        self.ring_offsets = np.zeros(1, dtype=np.int64) if ring_offsets is None else ring_offsets
+        self.polygon_offsets = np.zeros(1, dtype=np.int64) if polygon_offsets is None else polygon_offsets
+        self.feature_offsets = np.zeros(1, dtype=np.int64) if feature_offsets is None else feature_offsets
+        self.properties = {} if properties is None else properties
+        self.chunks = []
+
+    def __repr__(self):
+        return f"DetectionStore features={len(self)}, points={len(self.coordinates)}"
+
+    def __len__(self):
+        self.compact()
+        return len(self.feature_offsets) - 1
+
+    @classmethod
+    def from_features(cls, features):
+        '''
+        Args:
+            features (list of geojson.Feature): Polygon or MultiPolygon features
+        '''
+        points = []
+        ring_lengths = []
+        polygon_lengths = []
+        feature_lengths = []
+        properties = []
+        for feature in features:
+            geometry = feature["geometry"]
+            polygons = []
+            if geometry is not None:
+                if geometry["type"] == "Polygon":
+                    polygons = [geometry["coordinates"]]
+                elif geometry["type"] == "MultiPolygon":
+                    polygons = geometry["coordinates"]
+            for polygon in polygons:
+                for ring in polygon:
+                    points.extend(point[:2] for point in ring)
+                    ring_lengths.append(len(ring))
+                polygon_lengths.append(len(polygon))
+            feature_lengths.append(len(polygons))
+            properties.append(feature.get("properties") or {})
+        empty = np.zeros(1, dtype=np.int64)
+        names = {name for p in properties for name in p}
+        return cls(np.array(points, dtype=np.float64).reshape(-1, 2),
+                   _extend_offsets(empty, [np.array(ring_lengths, dtype=np.int64)]),
+                   _extend_offsets(empty, [np.array(polygon_lengths, dtype=np.int64)]),
+                   _extend_offsets(empty, [np.array(feature_lengths, dtype=np.int64)]),
+                   {name: _column([p.get(name) for p in properties]) for name in names})
+
+    def append_features(self, features):
+        '''
+        Append features (e.g. of one tile), arrays are concatenated lazily when they are accessed
+        Args:
+            features (list of geojson.Feature): Polygon or MultiPolygon features
+        '''
+        self.append(DetectionStore.from_features(features))
+
+    def append(self, detections):
+        '''
+        Append detections of another store (e.g. of one tile), arrays are concatenated lazily when they are accessed
+        Args:
+            detections (DetectionStore):
+        '''
+        detections.compact()
+        self.chunks.append(detections)
+
+    def compact(self):
+        '''
+        Concatenate appended chunks to the arrays
+        '''
+        if not self.chunks:
+            return
+        chunks, self.chunks = self.chunks, []
+        stores = [self] + chunks
+        # stores without a property get None values, stores without features are skipped
+        for name in {name for store in stores for name in store.properties}:
+            columns = [store.properties[name] if name in store.properties
+                       else np.full(len(store.feature_offsets) - 1, None, dtype=object)
+                       for store in stores if name in store.properties or len(store.feature_offsets) > 1]
+            if len({column.dtype for column in columns}) > 1:
+                columns = [column.astype(object) for column in columns]
+            self.properties[name] = np.concatenate(columns)
+        self.coordinates = np.concatenate([self.coordinates] + [c.coordinates for c in chunks])
+        self.ring_offsets = _extend_offsets(self.ring_offsets, [np.diff(c.ring_offsets) for c in chunks])
+        self.polygon_offsets = _extend_offsets(self.polygon_offsets, [np.diff(c.polygon_offsets) for c in chunks])
+        self.feature_offsets = _extend_offsets(self.feature_offsets, [np.diff(c.feature_offsets) for c in chunks])
+
+    def feature_rings(self):
+        '''
+        Returns: np.array with index of first ring of each feature, shape (num_features + 1,)
+        '''
+        self.compact()
+        return self.polygon_offsets[self.feature_offsets]
+
+    def ring_features(self):
+        '''
+        Returns: np.array with index of feature of each ring
+        '''
+        feature_rings = self.feature_rings()
+        return np.repeat(np.arange(len(feature_rings) - 1), np.diff(feature_rings))
+
+    def bounds(self):
+        '''
+        Returns: np.array with shape (num_features, 4) of minx, miny, maxx, maxy, nan for features without points
+        '''
+        feature_rings = self.feature_rings()
+        point_offsets = self.ring_offsets[feature_rings]
+        bounds = np.full((len(point_offsets) - 1, 4), np.nan)
+        nonempty = np.diff(point_offsets) > 0
+        if nonempty.any():
+            starts = point_offsets[:-1][nonempty]
+            bounds[nonempty, :2] = np.minimum.reduceat(self.coordinates, starts, axis=0)
+            bounds[nonempty, 2:] = np.maximum.reduceat(self.coordinates, starts, axis=0)
+        return bounds
+
+    def centroids(self):
+        '''
+        Returns: np.array with shape (num_features, 2), mean of points of each feature
+        '''
+        feature_rings = self.feature_rings()
+        point_offsets = self.ring_offsets[feature_rings]
+        counts = np.diff(point_offsets)
+        sums = np.zeros((len(counts), 2))
+        feature_of_point = np.repeat(np.arange(len(counts)), counts)
+        np.add.at(sums, feature_of_point, self.coordinates)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sums / counts[:, None]
+
+    def select(self, mask):
+        '''
+        Subset of features
+        Args:
+            mask (np.array): bool mask or indexes of features
+        Returns: DetectionStore
+        '''
+        self.compact()
+        indexes = np.flatnonzero(mask) if np.asarray(mask).dtype == bool else np.asarray(mask, dtype=np.int64)
+        polygon_offsets, polygon_index = _select_ranges(self.feature_offsets, indexes)
+        ring_offsets, ring_index = _select_ranges(self.polygon_offsets, polygon_index)
+        point_offsets, point_index = _select_ranges(self.ring_offsets, ring_index)
+        return DetectionStore(self.coordinates[point_index], point_offsets, ring_offsets, polygon_offsets,
+                              {name: column[indexes] for name, column in self.properties.items()})
+
+    def transform(self, transformator):
+        '''
+        Reproject all coordinates at once
+        Args:
+            transformator (EPSGTransformator):
+        Returns: DetectionStore with the same structure and new coordinates
+        '''
+        self.compact()
+        return DetectionStore(transformator.transform_array(self.coordinates), self.ring_offsets,
+                              self.polygon_offsets, self.feature_offsets, self.properties)
+
+    def draw(self, image, crsOrigin, pixelSize, color, **kwargs):
+        '''
+        Draw all rings to image, see draw_polygons
+        '''
+        self.compact()
+        return draw_polygons(image, crsOrigin, pixelSize, self.coordinates, self.ring_offsets, color, **kwargs)
+
+    def to_features(self):
+        '''
+        Returns: list of geojson.Feature, Polygon for features with one polygon, MultiPolygon otherwise
+        '''
+        self.compact()
+        coordinates = self.coordinates.tolist()
+        rings = [coordinates[start:end] for start, end in zip(self.ring_offsets[:-1], self.ring_offsets[1:])]
+        polygons = [rings[start:end] for start, end in zip(self.polygon_offsets[:-1], self.polygon_offsets[1:])]
+        features = []
+        for index, (start, end) in enumerate(zip(self.feature_offsets[:-1], self.feature_offsets[1:])):
+            if end - start == 1:
+                geometry = geojson.Polygon(polygons[start])
+            else:
+                geometry = geojson.MultiPolygon(polygons[start:end])
+            properties = {name: _python_value(column[index]) for name, column in self.properties.items()
+                          if column[index] is not None}
+            features.append(geojson.Feature(geometry=geometry, properties=properties))
+        return features
+
+    def save(self, path):
+        '''
+        Save to .npz file, or to .parquet file (one row per feature) if pyarrow is installed
+        '''
+        self.compact()
+        if path.endswith(".parquet"):
+            import pyarrow
+            import pyarrow.parquet
+            columns = {"geometry": [json.dumps(f["geometry"]) for f in self.to_features()]}
+            for name, column in self.properties.items():
+                columns["property_" + name] = column.tolist()
+            pyarrow.parquet.write_table(pyarrow.table(columns), path)
+            return
+        arrays = {
+            "coordinates": self.coordinates,
+            "ring_offsets": self.ring_offsets,
+            "polygon_offsets": self.polygon_offsets,
+            "feature_offsets": self.feature_offsets,
+        }
+        for name, column in self.properties.items():
+            if column.dtype == object:
+                column = np.array([json.dumps(_python_value(v)) for v in column])
+                arrays["json_property_" + name] = column
+            else:
+                arrays["property_" + name] = column
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        if path.endswith(".parquet"):
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(path).to_pydict()
+            features = []
+            for index, geometry in enumerate(table.pop("geometry")):
+                properties = {name[len("property_"):]: values[index] for name, values in table.items()
+                              if values[index] is not None}
+                features.append(geojson.Feature(geometry=json.loads(geometry), properties=properties))
+            return cls.from_features(features)
+        with np.load(path) as data:
+            properties = {}
+            for name in data.files:
+                if name.startswith("property_"):
+                    properties[name[len("property_"):]] = data[name]
+                elif name.startswith("json_property_"):
+                    properties[name[len("json_property_"):]] = _column([json.loads(v) for v in data[name]], numeric=False)
+            return cls(data["coordinates"], data["ring_offsets"], data["polygon_offsets"], data["feature_offsets"],
+                       properties)
+
+
+def _extend_offsets(offsets, lengths):
+    lengths = np.concatenate(lengths)
+    return np.concatenate([offsets, offsets[-1] + np.cumsum(lengths)])
+
+def _select_ranges(offsets, indexes):
+    '''
+    Offsets and indexes of children of selected parents
+    '''
+    starts = offsets[indexes]
+    lengths = offsets[indexes + 1] - starts
+    new_offsets = np.zeros(len(indexes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    child_index = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return new_offsets, child_index
+
+def _column(values, numeric=True):
+    if numeric and all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return np.array(values, dtype=np.int64)
+    if numeric and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+        return np.array(values, dtype=np.float64)
+    # object array of arbitrary values (e.g. lists) has to be filled one by one
+    column = np.empty(len(values), dtype=object)
+    for index, value in enumerate(values):
+        column[index] = value
+    return column
+
+def _python_value(value):
+    return value.item() if isinstance(value, np.generic) else value
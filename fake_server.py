@@ -0,0 +1,293 @@
+import io
+import base64
+import json
+import zlib
+import argparse
+import time
+import random
+import tarfile
+import threading
+import itertools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from ragnar import SKImage
+from spaceknow_tools import geometry_bounds
+
+
+def generate_ski(width, height, bands=("red", "green", "blue", "nir"), bitDepth=11, seed=0):
+    '''
+    Generate *.ski archive (tar.gz with info.json, meta.json and delta-coded 0000x.skb bands)
+    Args:
+        width (int): number of columns
+        height (int): number of rows
+        bands (list of string): names of bands
+        bitDepth (int): bit depth of values, bands are stored as uint16
+        seed (int): seed of random generator
+    Returns: bytes
+    '''
+    rng = np.random.default_rng(seed)
+    # smooth gradient with noise, similar to real scene and compressible as real scene
+    gradient = np.add.outer(np.arange(height, dtype=np.uint32), np.arange(width, dtype=np.uint32))
+    max_value = (1 << bitDepth) - 1
+    info = {"bands": [{"names": [name], "bitDepth": bitDepth} for name in bands]}
+    meta = {"bands": [{"names": [name]} for name in bands]}
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz", compresslevel=1) as tfile:
+        def add(name, data):
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tfile.addfile(tarinfo, io.BytesIO(data))
+
+        add("info.json", json.dumps(info).encode("utf-8"))
+        add("meta.json", json.dumps(meta).encode("utf-8"))
+        for index, _ in enumerate(bands):
+            noise = rng.integers(0, 16, size=(height, width), dtype=np.uint32)
+            band = ((gradient * (index + 1) + noise) % (max_value + 1)).astype(np.uint16)
+            add(str(index).zfill(5) + ".skb", SKImage.encode_skband(band))
+    return buf.getvalue()
+
+
+class FakeSpaceKnow:
+    def __init__(self, job_latency=1.0, num_scenes=4, tiles_per_scene=16, features_per_tile=50,
+                 image_size=1024, failure_rate=0.0, seed=0, token_lifetime=3600.0):
+        '''
+        Local stand-in of SpaceKnow APIs (auth0, imagery, kraken and tasking) for offline benchmarks
+        Args:
+            job_latency (float): seconds till a pipeline is RESOLVED
+            num_scenes (int): number of scenes returned by search
+            tiles_per_scene (int): number of detection tiles of one Kraken pipeline
+            features_per_tile (int): number of detections in one tile
+            image_size (int): width and height of generated images in pixels
+            failure_rate (float): probability of answering a request with 503
+            seed (int): seed of random generator
+            token_lifetime (float): seconds till issued id_token expires (exp claim)
+        '''
+        self.job_latency = job_latency
+        self.num_scenes = num_scenes
+        self.tiles_per_scene = tiles_per_scene
+        self.features_per_tile = features_per_tile
+        self.image_size = image_size
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.token_lifetime = token_lifetime
+        self.lock = threading.Lock()
+        self.pipelines = {}
+        self.pipeline_counter = itertools.count()
+        self.request_counts = {}
+        self.ski = None
+        self.server = None
+        self.thread = None
+
+    def __repr__(self):
+        return f"FakeSpaceKnow {self.url} scenes={self.num_scenes} tiles={self.tiles_per_scene} image={self.image_size}px"
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host="127.0.0.1", port=0):
+        handler = type("Handler", (_Handler,), {"fake": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="FakeSpaceKnow", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def bbox(self, extent):
+        bounds = geometry_bounds(extent)
+        return bounds if bounds is not None else (0.0, 0.0, 1.0, 1.0)
+
+    def id_token(self):
+        '''
+        Unsigned JWT with exp claim
+        '''
+        def encode(data):
+            return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).rstrip(b"=").decode("ascii")
+        claims = {"sub": "fake", "exp": int(time.time() + self.token_lifetime)}
+        return encode({"alg": "none", "typ": "JWT"}) + "." + encode(claims) + "."
+
+    def new_pipeline(self, kind, payload):
+        with self.lock:
+            pipelineId = f"{kind}-{next(self.pipeline_counter)}"
+            self.pipelines[pipelineId] = {"created": time.monotonic(), "kind": kind, "payload": payload}
+        return {"pipelineId": pipelineId, "status": "NEW"}
+
+    def status(self, pipelineId):
+        pipeline = self.pipelines[pipelineId]
+        if time.monotonic() - pipeline["created"] < self.job_latency:
+            return "PROCESSING"
+        return "RESOLVED"
+
+    def search_results(self, extent, startDatetime=None, endDatetime=None):
+        results = []
+        for index in range(self.num_scenes):
+            results.append({
+                "sceneId": f"scene-{index}",
+                "provider": "gbdx",
+                "dataset": "idaho-pansharpened",
+                "satellite": "FAKE-1",
+                "datetime": f"2020-01-{index % 28 + 1:02d} 00:{index // 28 % 60:02d}:00",
+                "crsEpsg": 4326,
+                "footprint": extent,
+                "cloudCover": self.random.random(),
+                "offNadir": self.random.uniform(0.0, 30.0),
+                "sunElevation": self.random.uniform(20.0, 70.0),
+                "anomalousRatio": 0.0,
+                "bands": [self.band(name, extent) for name in ("red", "green", "blue", "nir")],
+            })
+        # datetime strings of the same format compare as datetimes
+        return [scene for scene in results
+                if (startDatetime is None or scene["datetime"] >= startDatetime)
+                and (endDatetime is None or scene["datetime"] <= endDatetime)]
+
+    def band(self, name, extent):
+        minx, miny, maxx, maxy = self.bbox(extent)
+        return {
+            "names": [name],
+            "bitDepth": 11,
+            "gsd": 0.5,
+            "pixelSizeX": (maxx - minx) / self.image_size,
+            "pixelSizeY": -(maxy - miny) / self.image_size,
+            "crsOriginX": minx,
+            "crsOriginY": maxy,
+            "approximateResolutionX": 0.5,
+            "approximateResolutionY": 0.5,
+        }
+
+    def image(self):
+        with self.lock:
+            if self.ski is None:
+                self.ski = generate_ski(self.image_size, self.image_size)
+            return self.ski
+
+    def detections(self, mapId, x, y):
+        pipeline = self.pipelines[mapId]
+        minx, miny, maxx, maxy = self.bbox(pipeline["payload"]["extent"])
+        map_type = pipeline["payload"].get("mapType", "cars")
+        rng = np.random.default_rng(zlib.crc32(f"{mapId}/{x}/{y}".encode("utf-8")))
+        size = (maxx - minx) / self.image_size * 8
+        corners = rng.uniform((minx, miny), (maxx, maxy), size=(self.features_per_tile, 2))
+        features = []
+        for cx, cy in corners.tolist():
+            ring = [[cx, cy], [cx + size, cy], [cx + size, cy + size / 2], [cx, cy + size / 2], [cx, cy]]
+            features.append({"type": "Feature", "properties": {"class": map_type},
+                             "geometry": {"type": "Polygon", "coordinates": [ring]}})
+        return {"type": "FeatureCollection", "features": features}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count(self, route):
+        with self.fake.lock:
+            self.fake.request_counts[route] = self.fake.request_counts.get(route, 0) + 1
+
+    def fail(self):
+        if self.fake.failure_rate > 0 and self.fake.random.random() < self.fake.failure_rate:
+            self.send(503, {"error": "fake failure"})
+            return True
+        return False
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if self.fail():
+            return
+        if parts[0] == "ski":
+            self.count("ski")
+            self.send(200, self.fake.image(), "application/octet-stream")
+        elif parts[:2] == ["kraken", "grid"] and len(parts) == 8:
+            self.count("kraken/grid")
+            _, _, mapId, _, _, x, y, _ = parts
+            self.send(200, self.fake.detections(mapId, int(x), int(y)))
+        else:
+            self.send(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.fail():
+            return
+        fake = self.fake
+        path = self.path.strip("/")
+        self.count(path)
+        if path == "oauth/ro":
+            self.send(200, {"id_token": fake.id_token()})
+            return
+        payload = json.loads(body) if body else {}
+        if path == "tasking/get-status":
+            self.send(200, {"status": fake.status(payload["pipelineId"])})
+        elif path == "imagery/search/initiate":
+            self.send(200, fake.new_pipeline("search", payload))
+        elif path == "imagery/search/retrieve":
+            search = fake.pipelines[payload["pipelineId"]]["payload"]
+            self.send(200, {"results": fake.search_results(search["extent"], search.get("startDatetime"),
+                                                           search.get("endDatetime"))})
+        elif path == "imagery/get-image/initiate":
+            self.send(200, fake.new_pipeline("image", payload))
+        elif path == "imagery/get-image/retrieve":
+            extent = fake.pipelines[payload["pipelineId"]]["payload"]["extent"]
+            meta = {"bands": [fake.band(name, extent) for name in ("red", "green", "blue", "nir")]}
+            self.send(200, {"meta": meta, "extent": extent, "url": f"{fake.url}/ski/{payload['pipelineId']}.ski"})
+        elif path.startswith("kraken/release/") and path.endswith("/geojson/initiate"):
+            self.send(200, fake.new_pipeline("kraken", dict(payload, mapType=path.split("/")[2])))
+        elif path.startswith("kraken/release/") and path.endswith("/geojson/retrieve"):
+            side = max(1, int(round(fake.tiles_per_scene ** 0.5)))
+            tiles = [[16, x, y] for x, y in itertools.product(range(side), repeat=2)][:fake.tiles_per_scene]
+            self.send(200, {"mapId": payload["pipelineId"], "tiles": tiles})
+        else:
+            self.send(404, {"error": f"unknown path {self.path}"})
+
+
+def use_server(url):
+    '''
+    Redirect all API classes to server at url, e.g. to FakeSpaceKnow
+    '''
+    import ragnar
+    import kraken
+    import task_in_progress
+    import spaceknow_tools
+    ragnar.URL = url
+    kraken.URL = url
+    task_in_progress.URL = url
+    spaceknow_tools.KRAKEN_URL = url
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", help="port of server", type=int, default=8080)
+    ap.add_argument("--job-latency", help="seconds till a pipeline is RESOLVED", type=float, default=1.0)
+    ap.add_argument("--scenes", help="number of scenes returned by search", type=int, default=4)
+    ap.add_argument("--tiles", help="number of detection tiles per scene", type=int, default=16)
+    ap.add_argument("--features-per-tile", help="number of detections in one tile", type=int, default=50)
+    ap.add_argument("--image-size", help="width and height of images in pixels", type=int, default=1024)
+    ap.add_argument("--failure-rate", help="probability of 503 response", type=float, default=0.0)
+    args = vars(ap.parse_args())
+    fake = FakeSpaceKnow(job_latency=args["job_latency"], num_scenes=args["scenes"], tiles_per_scene=args["tiles"],
+                         features_per_tile=args["features_per_tile"], image_size=args["image_size"],
+                         failure_rate=args["failure_rate"])
+    fake.start(port=args["port"])
+    print(fake)
+    fake.thread.join()
@@ -0,0 +1,85 @@
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# hosts of SpaceKnow APIs, authorization header is sent only to them
+API_HOSTS = [
+    "spaceknow-imagery.appspot.com",
+    "spaceknow-kraken.appspot.com",
+    "spaceknow-tasking.appspot.com",
+]
+AUTH_HOSTS = [
+    "spaceknow.auth0.com",
+    "spaceknow-test.auth0.com",
+]
+
+
+class SpaceKnowClient:
+    def __init__(self, auth=None, pool_maxsize=32, retries=5, backoff_factor=0.5, timeout=(10.0, 120.0),
+                 api_hosts=API_HOSTS):
+        '''
+        HTTP client shared by all API classes. It keeps pool of keep-alive connections per host,
+        retries transient errors (connection errors, 429 and 5xx) with exponential backoff,
+        applies timeouts and adds authorization header to requests to SpaceKnow APIs.
+        Args:
+            auth (Authorization): source of authorization header, it can be set later
+            pool_maxsize (int): maximal number of connections to one host
+            retries (int): maximal number of retries of one request
+            backoff_factor (float): delay before n-th retry is backoff_factor * 2^(n-1) seconds
+            timeout (tuple of float): connect and read timeout in seconds
+            api_hosts (list of string): hosts which get authorization header
+        '''
+        self.auth = auth
+        self.timeout = timeout
+        self.api_hosts = list(api_hosts)
+        # get-status and retrieve are POST requests which only read state of pipeline, they can be repeated
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+            respect_retry_after_header=True,
+            raise_on_status=False)
+        # initiate creates new pipeline (and spends credits) even if its response is lost, so it is
+        # retried only when the request did not reach server
+        initiate_retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=backoff_factor,
+            allowed_methods=None,
+            raise_on_status=False)
+        self.session = requests.Session()
+        self.initiate_session = requests.Session()
+        for session, max_retries in ((self.session, retry), (self.initiate_session, initiate_retry)):
+            for host in self.api_hosts + AUTH_HOSTS:
+                session.mount("https://" + host, HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=max_retries))
+            # other hosts, e.g. storage of *.ski files or local server
+            for prefix in ("https://", "http://"):
+                session.mount(prefix, HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=max_retries))
+
+    def __repr__(self):
+        return f"SpaceKnowClient auth={self.auth}"
+
+    def headers(self, url):
+        if urlparse(url).hostname not in self.api_hosts:
+            return {}
+        if self.auth is None:
+            return {"Content-Type": "application/json"}
+        return self.auth.headers()
+
+    def request(self, method, url, **kwargs):
+        headers = self.headers(url)
+        headers.update(kwargs.pop("headers", None) or {})
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.initiate_session if urlparse(url).path.endswith("/initiate") else self.session
+        return session.request(method, url, headers=headers, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from metrics import metrics
+
+# format -> extension of image file and of world file
+FORMATS = {
+    "png": (".png", ".pgw"),
+    "jpeg": (".jpg", ".jgw"),
+    "webp": (".webp", ".wld"),
+    "npy": (".npy", ".wld"),
+}
+
+
+def encode_params(format, png_level=None, quality=None):
+    '''
+    Returns: list of cv2.imwrite parameters
+    '''
+    if format == "png" and png_level is not None:
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_level]
+    if format == "jpeg" and quality is not None:
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if format == "webp" and quality is not None:
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    return []
+
+
+def georeference(band, width, height, crsEpsg=None):
+    '''
+    Georeferencing of image from band with crsOriginX/Y and pixelSizeX/Y
+    Returns: tuple (lines of world file, dict for JSON sidecar)
+    '''
+    # world file refers to centre of upper left pixel, crsOrigin is its corner
+    world = [band["pixelSizeX"], 0.0, 0.0, band["pixelSizeY"],
+             band["crsOriginX"] + band["pixelSizeX"] / 2, band["crsOriginY"] + band["pixelSizeY"] / 2]
+    sidecar = {
+        "crsEpsg": crsEpsg,
+        "crsOriginX": band["crsOriginX"],
+        "crsOriginY": band["crsOriginY"],
+        "pixelSizeX": band["pixelSizeX"],
+        "pixelSizeY": band["pixelSizeY"],
+        "width": width,
+        "height": height,
+    }
+    return [repr(float(value)) for value in world], sidecar
+
+
+def write_image(img_file, image, format="png", params=(), preview_size=None, band=None, crsEpsg=None):
+    '''
+    Encode and write image atomically (to temporary file which is renamed), optionally with downscaled
+    JPEG preview and georeferencing sidecars (world file and JSON). It runs in worker process of ImageWriter.
+    Returns: seconds spent by encoding and writing
+    '''
+    start = time.perf_counter()
+    extension, world_extension = FORMATS[format]
+    base, _ = os.path.splitext(img_file)
+    temp_file = base + ".tmp" + extension
+    if format == "npy":
+        np.save(temp_file, image)
+    elif not cv2.imwrite(temp_file, image, list(params)):
+        raise IOError(f"Image {img_file} can not be written")
+    os.replace(temp_file, img_file)
+
+    if preview_size is not None:
+        height, width = image.shape[:2]
+        scale = preview_size / max(height, width)
+        if scale < 1.0:
+            preview = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))),
+                                 interpolation=cv2.INTER_AREA)
+        else:
+            preview = image
+        cv2.imwrite(base + "_preview.jpg", preview, [cv2.IMWRITE_JPEG_QUALITY, 85])
+
+    if band is not None:
+        world, sidecar = georeference(band, image.shape[1], image.shape[0], crsEpsg)
+        with open(base + world_extension, "w") as f:
+            f.write("\n".join(world) + "\n")
+        with open(base + ".geo.json", "w") as f:
+            json.dump(sidecar, f, indent=2)
+    return time.perf_counter() - start
+
+
+class ImageWriter:
+    def __init__(self, format="png", png_level=None, quality=None, workers=2, max_pending=4, preview_size=None,
+                 georeferenced=False):
+        '''
+        Encode and write output images in worker processes, so the next scene does not wait for it
+        Args:
+            format (string): png, jpeg, webp or npy (uncompressed)
+            png_level (int): PNG compression level 0..9
+            quality (int): JPEG or WebP quality 0..100
+            workers (int): number of worker processes, images are encoded in parallel
+            max_pending (int): maximal number of images waiting for worker, submit blocks when it is reached
+            preview_size (int): if set, JPEG preview downscaled to this size of longer side is written too
+            georeferenced (bool): write world file and JSON sidecar with crs, origin and pixel size
+        '''
+        assert format in FORMATS
+        self.format = format
+        self.params = encode_params(format, png_level, quality)
+        self.preview_size = preview_size
+        self.georeferenced = georeferenced
+        self.workers = workers
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.lock = threading.Lock()
+        # spawn, fork of process with running threads is not safe
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def __repr__(self):
+        return f"ImageWriter {self.format} workers={self.workers}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def extension(self):
+        return FORMATS[self.format][0]
+
+    def submit(self, img_file, image, band=None, crsEpsg=None):
+        '''
+        Queue image for writing, it blocks while max_pending images are waiting
+        Args:
+            img_file (string): name of image file, its extension should be self.extension
+            image (np.array): BGR image, it must not be modified till it is written
+            band (dict): band with crsOriginX/Y and pixelSizeX/Y of image, used for georeferencing
+            crsEpsg (int): crs of image
+        Returns: Future, its result is seconds spent by writing
+        '''
+        with metrics.timer("render_seconds", stage="queue"):
+            self.pending.acquire()
+        future = self.executor.submit(write_image, img_file, np.asarray(image), self.format, self.params,
+                                      self.preview_size, band if self.georeferenced else None, crsEpsg)
+        future.add_done_callback(self._done)
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def _done(self, future):
+        self.pending.release()
+        if future.exception() is None:
+            metrics.observe("render_seconds", future.result(), stage="encode")
+
+    def close(self):
+        '''
+        Wait till all images are written
+        Raises: the first error of writing
+        '''
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import threading
+
+
+class PipelineJournal:
+    def __init__(self, journal_file):
+        '''
+        Append-only JSONL journal of initiated pipelines and finished outputs, so that interrupted run
+        can resume polling of pipelines which are still running on server instead of initiating new ones.
+        Jobs are identified by their cache_key (request parameters), see cache.py
+        Args:
+            journal_file (string): path to journal, it is created if it does not exist
+        '''
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.pipelines = {}
+        self.outputs = {}
+        if os.path.isfile(journal_file):
+            self.load()
+        self.file = open(journal_file, "a")
+
+    def __repr__(self):
+        return f"PipelineJournal {self.journal_file} pipelines={len(self.pipelines)}, outputs={len(self.outputs)}"
+
+    def load(self):
+        with open(self.journal_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of interrupted run may be incomplete
+                    continue
+                if entry.get("type") == "pipeline":
+                    self.pipelines[entry["key"]] = entry
+                elif entry.get("type") == "output":
+                    self.outputs[entry["key"]] = entry
+
+    def append(self, entry):
+        entry["time"] = time.time()
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def record(self, job):
+        '''
+        Record pipelineId and status of job, jobs without pipelineId (e.g. cache hits) are not recorded
+        '''
+        if getattr(job, "pipelineId", None) is None:
+            return
+        entry = {
+            "type": "pipeline",
+            "key": job.cache_key,
+            "job": type(job).__name__,
+            "sceneId": getattr(job, "sceneId", None),
+            "pipelineId": job.pipelineId,
+            "status": job.status,
+        }
+        self.pipelines[job.cache_key] = entry
+        self.append(entry)
+
+    def resume(self, job):
+        '''
+        Set pipelineId and status of job from journal if its pipeline was initiated before and did not fail
+        Returns: True if job was resumed
+        '''
+        entry = self.pipelines.get(job.cache_key)
+        if entry is None or entry["status"] not in ["NEW", "PROCESSING", "RESOLVED"]:
+            return False
+        job.pipelineId = entry["pipelineId"]
+        # status is checked again, pipeline could change since the last record
+        job.status = "PROCESSING"
+        return True
+
+    def record_output(self, key, output):
+        entry = {"type": "output", "key": key, "output": output}
+        self.outputs[key] = entry
+        self.append(entry)
+
+    def output(self, key):
+        '''
+        Returns: output recorded under key if it still exists, otherwise None
+        '''
+        entry = self.outputs.get(key)
+        if entry is None or not os.path.exists(entry["output"]):
+            return None
+        return entry["output"]
@@ -1,31 +1,53 @@
-import json
-import requests
-from task_in_progress import TaskInProgress
-from spaceknow_tools import DetectionTile
+import numpy as np
+from task_in_progress import TaskInProgress, PollingBackoff
+from spaceknow_tools import TileFetcher, DetectionDeduplicator
+from cache import kraken_key
+from detections import DetectionStore
 
 
 URL = "https://spaceknow-kraken.appspot.com"
+MAP_TYPES = ["imagery", "aircraft", "ships", "wrunc", "cars", "containers", "boats",
+             "solar-panels", "pools", "houses", "coal", "cranes", "lithium", "cows",
+             "change", "s2-change", "sar-change", "wrunc-change", "eme", "trees", "ndvi"]
 
 class Kraken(TaskInProgress):
-    def __init__(self, sceneId, extent, map_type, headers={"content-type": "application/json"}):
+    backoff = PollingBackoff(initial=2.0, maximum=15.0)
+
+    def __init__(self, sceneId, extent, map_type, headers={"content-type": "application/json"}, tile_fetcher=None,
+                 cache=None, client=None, deduplicator=None, keep_features=True, clipper=None):
         self.sceneId = sceneId
         self.extent = extent
-        assert map_type in ["imagery", "aircraft", "ships", "wrunc", "cars", "containers", "boats",
-                            "solar-panels", "pools", "houses", "coal", "cranes", "lithium", "cows",
-                            "change", "s2-change", "sar-change", "wrunc-change", "eme", "trees", "ndvi"]
+        assert map_type in MAP_TYPES
         self.map_type = map_type
+        # detections are collected in columnar store, list of geojson features is optional
+        self.keep_features = keep_features
         self.features = []
+        self.detections = DetectionStore()
+        # detections in tiles before clipping, deduplicator counts detections before and after removing duplicates
+        self.raw_count = 0
+        # features from different tiles are deduplicated, pass False to keep duplicates
+        self.deduplicator = DetectionDeduplicator() if deduplicator is None else deduplicator
+        # detections outside the extent polygon (ExtentClipper) are dropped as tiles come
+        self.clipper = clipper
         self.headers = headers
+        self.client = client
+        self.tile_fetcher = tile_fetcher if tile_fetcher is not None else TileFetcher(session=client, cache=cache)
+        self.cache = cache
+        self.cache_key = kraken_key(sceneId, extent, map_type)
+        self.cached_response = None
 
     def initiate(self):
+        if self.cache is not None:
+            self.cached_response = self.cache.get_json(self.cache_key)
+            if self.cached_response is not None:
+                self.status = "RESOLVED"
+                return
+
         payload = {
             "sceneId": self.sceneId,
             "extent": self.extent
         }
-        response = requests.post(
-            URL + "/kraken/release/" + self.map_type + "/geojson/initiate",
-            headers=self.headers,
-            data=json.dumps(payload))
+        response = self.post(URL + "/kraken/release/" + self.map_type + "/geojson/initiate", payload)
         if response.status_code == 200:
             response_json = response.json()
             self.pipelineId = response_json["pipelineId"]
@@ -35,23 +57,46 @@ class Kraken(TaskInProgress):
             print(response.json())
             self.status = "FAILED"
 
-    def retrieve(self):
-        "/kraken/release/{map_type}/geojson/retrieve"
+    def retrieve(self, on_tile=None):
+        '''
+        "/kraken/release/{map_type}/geojson/retrieve", detection tiles are downloaded by tile_fetcher
+        Args:
+            on_tile (function): called with features of each tile as soon as the tile is downloaded
+        '''
+        if self.cached_response is not None:
+            self.retrieve_tiles(self.cached_response["mapId"], self.cached_response["tiles"], on_tile)
+            return
         payload = {
             "pipelineId": self.pipelineId
         }
-        response = requests.post(
-            URL + "/kraken/release/" + self.map_type + "/geojson/retrieve",
-            headers=self.headers,
-            data=json.dumps(payload))
+        response = self.post(URL + "/kraken/release/" + self.map_type + "/geojson/retrieve", payload)
         if response.status_code == 200:
             response_json = response.json()
-            response_json
             maiId = response_json["mapId"]
             tiles = response_json["tiles"]
-            for tile in tiles:
-                dt = DetectionTile(maiId, tile)
-                self.features.extend(dt.features)
+            self.retrieve_tiles(maiId, tiles, on_tile)
+            if self.cache is not None:
+                self.cache.put_json(self.cache_key, {"mapId": maiId, "tiles": tiles})
         else:
             print(response.status_code)
             print(response.json())
+
+    def retrieve_tiles(self, mapId, tiles, on_tile=None):
+        for dt in self.tile_fetcher.fetch(mapId, tiles):
+            features = dt.features
+            self.raw_count += len(features)
+            # features of tile are converted to arrays once, clipping and deduplication work on them
+            store = DetectionStore.from_features(features)
+            keep = np.ones(len(features), dtype=bool)
+            if self.clipper is not None:
+                keep = self.clipper.select(store)
+            if self.deduplicator:
+                keep[keep] = self.deduplicator.add_bounds(store.bounds()[keep])
+            if not keep.all():
+                store = store.select(keep)
+                features = [feature for feature, selected in zip(features, keep) if selected]
+            self.detections.append(store)
+            if self.keep_features:
+                self.features.extend(features)
+            if on_tile is not None:
+                on_tile(features)
@@ -3,13 +3,22 @@ import time
 import json
 import argparse
 import geojson
-import re
 import numpy as np
-import cv2
 from authorization import SpaceKnowTestAuth, SpaceKnowAuth
-from ragnar import SearchScene, SatelliteImagery, GetImage
-from kraken import Kraken
-from spaceknow_tools import draw_extent, EPSGTransformator
+from ragnar import SearchScene, SatelliteImagery
+from kraken import MAP_TYPES
+from cache import DiskCache
+from journal import PipelineJournal
+from planner import ScenePlanner, BUCKETS
+from http_client import SpaceKnowClient
+from metrics import metrics
+from image_writer import ImageWriter, FORMATS
+from timeseries import TimeSeriesStore
+from clipping import MODES
+from density import DensityGrid
+from spaceknow_tools import TileFetcher
+from pipeline import run_job, run_scenes
+from batch import load_extents, run_batch
 
 
 if __name__ == '__main__':
@@ -17,55 +26,144 @@ if __name__ == '__main__':
     ap.add_argument("-u", "--username", help="username of Spaceknow account", required=False)
     ap.add_argument("-p", "--password", help="password of Spaceknow account", required=False)
     ap.add_argument("-t", "--token-file", help="file where to save/load token for future usage", required=False, default=None)
-    ap.add_argument("-g", "--geojson", help="GeoJSON file that contains single Geometry", required=True)
+    source = ap.add_mutually_exclusive_group(required=True)
+    source.add_argument("-g", "--geojson", help="GeoJSON file that contains single Geometry")
+    source.add_argument("-b", "--batch", help="GeoJSON files or directories with them, near extents share scenes", nargs="+")
+    ap.add_argument("-m", "--map-types", help="map types of Kraken drawn to one image", nargs="+", choices=MAP_TYPES, default=["cars"])
+    ap.add_argument("--max-gap", help="maximal distance of extents in degrees to search them together in batch mode", type=float, default=0.01)
+    ap.add_argument("--max-concurrency", help="maximal number of Kraken and GetImage jobs in flight", type=int, default=8)
+    ap.add_argument("--max-polls-per-second", help="maximal rate of job status requests", type=float, default=5.0)
+    ap.add_argument("--tile-workers", help="number of detection tiles downloaded at once", type=int, default=16)
+    ap.add_argument("--cache-dir", help="directory of cache of search results, detections and images", default=None)
+    ap.add_argument("--cache-size-mb", help="maximal size of cache in MB", type=int, default=10 * 1024)
+    ap.add_argument("--max-cloud-cover", help="skip scenes with higher cloud cover (0..1)", type=float, default=None)
+    ap.add_argument("--max-off-nadir", help="skip scenes with higher off-nadir angle in degrees", type=float, default=None)
+    ap.add_argument("--min-sun-elevation", help="skip scenes with lower sun elevation in degrees", type=float, default=None)
+    ap.add_argument("--max-anomalous-ratio", help="skip scenes with higher anomalous ratio (0..1)", type=float, default=None)
+    ap.add_argument("--min-intersection", help="skip scenes covering smaller part of extent (0..1)", type=float, default=None)
+    ap.add_argument("--best-per-bucket", help="process only N best scenes per time bucket", type=int, default=None)
+    ap.add_argument("--bucket", help="time bucket of --best-per-bucket", choices=BUCKETS, default="day")
+    ap.add_argument("--duplicate-minutes", help="scenes of one satellite within this time are duplicates", type=float, default=None)
+    ap.add_argument("--dry-run", help="only print which scenes would be processed", action="store_true")
+    ap.add_argument("--journal", help="journal file of pipelines, interrupted run is resumed from it", default=None)
+    ap.add_argument("--image-tile-size", help="request images of large extents in tiles of this size in pixels", type=int, default=None)
+    ap.add_argument("--streaming", help="spool images to disk and decode their bands lazily", action="store_true")
+    ap.add_argument("--mmap-dir", help="directory where bands of images are decoded into memory-mapped files", default=None)
+    ap.add_argument("--timeseries", help="directory of time series store, only scenes new since the last run are processed", default=None)
+    ap.add_argument("--series-output", help="CSV or Parquet file where to save count series of --timeseries", default=None)
+    ap.add_argument("--clip", help="which detections are inside extent, none keeps all", choices=MODES + ["none"], default="centroid")
+    ap.add_argument("--density", help="directory of detection density rasters of each period, updated by each run", default=None)
+    ap.add_argument("--density-cell-size", help="size of cell of density grid in metres", type=float, default=10.0)
+    ap.add_argument("--density-period", help="time period of one density raster", choices=BUCKETS, default="month")
+    ap.add_argument("--no-images", help="do not request and save images of scenes, only count detections", action="store_true")
+    ap.add_argument("--format", help="format of output images", choices=list(FORMATS), default="png")
+    ap.add_argument("--png-level", help="PNG compression level 0..9", type=int, default=None)
+    ap.add_argument("--quality", help="JPEG or WebP quality 0..100", type=int, default=None)
+    ap.add_argument("--preview-size", help="write also JPEG preview with longer side of this size", type=int, default=None)
+    ap.add_argument("--georeference", help="write world file and JSON sidecar with georeferencing of images", action="store_true")
+    ap.add_argument("--encode-workers", help="number of processes encoding output images", type=int, default=2)
+    ap.add_argument("--metrics", help="JSON file where to save metrics of the run", default=None)
+    ap.add_argument("--metrics-prometheus", help="file where to save metrics in Prometheus text format", default=None)
+    ap.add_argument("--trace", help="Chrome trace-event JSON file with spans of each scene", default=None)
     args = vars(ap.parse_args())
+    metrics.tracing = args["trace"] is not None
 
     geojson_file = args["geojson"]
     token_file = args.get("token_file")
     username = args.get("username", "")
     password = args.get("password", "")
     # auth = SpaceKnowAuth(username="a6427229@nwytg.net", password="AW3EDCc", token_file="token_file.json")
-    auth = SpaceKnowAuth(username=args.get("username"), password=args.get("password"), token_file=token_file)
+    client = SpaceKnowClient()
+    auth = SpaceKnowAuth(username=args.get("username"), password=args.get("password"), token_file=token_file,
+                         client=client)
+    client.auth = auth
 
-    extent = geojson.load(open(geojson_file))
-    satelit = SatelliteImagery("gbdx", "idaho-pansharpened")
-    search = SearchScene(satelit, extent, headers=auth.headers())
-    status, pipelineId = search.initiate()
-    search.wait_till_job_is_done()
+    cache = None
+    if args["cache_dir"] is not None:
+        cache = DiskCache(args["cache_dir"], max_bytes=args["cache_size_mb"] * 1024 ** 2)
+
+    journal = None
+    if args["journal"] is not None:
+        journal = PipelineJournal(args["journal"])
+
+    planner = ScenePlanner(max_cloud_cover=args["max_cloud_cover"], max_off_nadir=args["max_off_nadir"],
+                           min_sun_elevation=args["min_sun_elevation"], max_anomalous_ratio=args["max_anomalous_ratio"],
+                           min_intersection=args["min_intersection"], best_per_bucket=args["best_per_bucket"],
+                           bucket=args["bucket"], duplicate_minutes=args["duplicate_minutes"])
 
-    # Searching Scene is done
-    if search.status == "RESOLVED":
-        search.retrieve()
-        for metadata in search.results:
-            # get detections and draw cars to image
-            features = []
-            kraken = Kraken(metadata.sceneId, extent, "cars", auth.headers())
-            kraken.initiate()
-            kraken.wait_till_job_is_done()
-            if kraken.status == "RESOLVED":
-                kraken.retrieve()
-                features.extend(kraken.features)
+    timeseries = None
+    if args["timeseries"] is not None:
+        timeseries = TimeSeriesStore(args["timeseries"])
 
-                # download .ski file and extract image
-                getimage = GetImage(sceneId=metadata.sceneId, extent=extent, headers=auth.headers())
-                getimage.initiate()
-                getimage.wait_till_job_is_done()
-                if getimage.status == "RESOLVED":
-                    getimage.retrieve()
-                    rgb_image = getimage.skimage.imageRGB
-                    crsOriginXY = getimage.meta["bands"][0]["crsOriginX"], getimage.meta["bands"][0]["crsOriginY"]
-                    pixelSizeXY = getimage.meta["bands"][0]["pixelSizeX"], getimage.meta["bands"][0]["pixelSizeY"]
+    clip = None if args["clip"] == "none" else args["clip"]
+
+    satelit = SatelliteImagery("gbdx", "idaho-pansharpened")
+    tile_fetcher = TileFetcher(workers=args["tile_workers"], session=client, cache=cache)
+    writer = ImageWriter(format=args["format"], png_level=args["png_level"], quality=args["quality"],
+                         workers=args["encode_workers"], preview_size=args["preview_size"],
+                         georeferenced=args["georeference"])
+    if args["batch"] is not None:
+        extents = load_extents(args["batch"])
+    else:
+        extents = {os.path.splitext(os.path.basename(geojson_file))[0]: geojson.load(open(geojson_file))}
+    densities = None
+    if args["density"] is not None:
+        try:
+            densities = {name: DensityGrid.open(os.path.join(args["density"], name + ".npz"), extent,
+                                                cell_size=args["density_cell_size"], period=args["density_period"])
+                         for name, extent in extents.items()}
+        except ValueError as e:
+            ap.error(str(e))
 
-                    trans = EPSGTransformator(metadata.crsEpsg)
-                    for feature in features:
-                        polygons1 = feature["geometry"]["coordinates"]
-                        polygons2 = [trans.transform(polygon) for polygon in polygons1]
-                        draw_extent(rgb_image, crsOriginXY, pixelSizeXY, polygons2, (255, 0, 0))
+    if args["batch"] is not None:
+        run_batch(extents, satelit, auth.headers(), max_gap=args["max_gap"],
+                  max_concurrency=args["max_concurrency"], max_polls_per_second=args["max_polls_per_second"],
+                  tile_fetcher=tile_fetcher, cache=cache, client=client, image_tile_size=args["image_tile_size"],
+                  streaming=args["streaming"], mmap_dir=args["mmap_dir"],
+                  journal=journal, planner=planner, dry_run=args["dry_run"], map_types=args["map_types"],
+                  writer=writer, timeseries=timeseries, clip=clip, densities=densities, images=not args["no_images"])
+    else:
+        name, extent = list(extents.items())[0]
+        if timeseries is None:
+            search = SearchScene(satelit, extent, headers=auth.headers(), cache=cache, client=client)
+        else:
+            # cached results of search from the same watermark would miss new scenes
+            timeseries.state(extent, name=name)
+            startDatetime = planner.search_start(timeseries.watermark(extent, args["map_types"]))
+            search = SearchScene(satelit, extent, startDatetime=startDatetime, headers=auth.headers(), client=client)
+        run_job(search, journal=journal)
 
-                # print result depends on shoot time
-                img_file = metadata.datetime + "_" + metadata.satellite + ".png"
-                img_file = re.sub('[^-a-zA-Z0-9_.()]+', '_', img_file)
-                print(metadata.datetime, metadata.satellite)
-                cv2.imwrite(img_file, rgb_image)
-                print(f"Image saved to {img_file}")
-                print(f"Number of cars is {len(features)}")
+        # Searching Scene is done
+        if search.status == "RESOLVED":
+            # processed scenes are planned too, so a new scene does not replace better processed one in its bucket
+            scenes, rejected = planner.plan(search.results, extent)
+            planner.report(scenes, rejected)
+            if timeseries is not None:
+                scenes = timeseries.new_scenes(extent, scenes, args["map_types"])
+                print(f"{len(scenes)} new scenes since {timeseries.watermark(extent, args['map_types'])}")
+        if search.status == "RESOLVED" and not args["dry_run"]:
+            run_scenes(scenes, extent, auth.headers(), max_concurrency=args["max_concurrency"],
+                       max_polls_per_second=args["max_polls_per_second"], tile_fetcher=tile_fetcher,
+                       cache=cache, client=client, image_tile_size=args["image_tile_size"], journal=journal,
+                       streaming=args["streaming"], mmap_dir=args["mmap_dir"],
+                       map_types=args["map_types"], writer=writer, timeseries=timeseries,
+                       clip=clip, density=densities[name] if densities is not None else None,
+                       images=not args["no_images"])
+    # wait till all images are written
+    writer.close()
+    if densities is not None:
+        for name, density in densities.items():
+            density.save(os.path.join(args["density"], name + ".npz"))
+            files = density.save_rasters(args["density"], prefix=name + "_")
+            print(f"{name}: {density}, {len(files)} rasters saved to {args['density']}")
+    if timeseries is not None and args["series_output"] is not None:
+        timeseries.save_series(args["series_output"], extents)
+        print(f"Count series saved to {args['series_output']}")
+    if cache is not None:
+        print(cache)
+    if args["metrics"] is not None:
+        metrics.save_json(args["metrics"])
+    if args["metrics_prometheus"] is not None:
+        metrics.save_prometheus(args["metrics_prometheus"])
+    if args["trace"] is not None:
+        metrics.save_trace(args["trace"])
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import bisect
+import threading
+
+# upper bounds of buckets of histograms of durations in seconds
+TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0, 300.0]
+
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        '''
+        Counts of observed values in buckets with given upper bounds, the last bucket is +Inf
+        '''
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        '''
+        Returns: list of tuples (upper bound, number of values <= upper bound), the last bound is inf
+        '''
+        total = 0
+        ret = []
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            total += count
+            ret.append((bound, total))
+        return ret
+
+    def quantile(self, q):
+        '''
+        Upper bound of bucket which contains q-quantile, max for the +Inf bucket
+        '''
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": [["+Inf" if bound == float("inf") else bound, total] for bound, total in self.cumulative()],
+        }
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.perf_counter()
+        self.elapsed = self.end - self.start
+        self.registry.observe(self.name, self.elapsed, **self.labels)
+        if self.registry.tracing:
+            self.registry.span(self.name, self.start, self.end, **self.labels)
+
+
+class _SceneContext:
+    def __init__(self, registry, sceneId):
+        self.registry = registry
+        self.sceneId = sceneId
+
+    def __enter__(self):
+        self.previous = getattr(self.registry.local, "scene", None)
+        self.registry.local.scene = self.sceneId
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.local.scene = self.previous
+
+
+class MetricsRegistry:
+    def __init__(self, prefix="spaceknow_", tracing=False):
+        '''
+        Thread-safe counters and histograms of the client pipeline, optionally with trace of spans
+        Args:
+            prefix (string): prefix of names of metrics in Prometheus format
+            tracing (bool): record spans for Chrome trace (chrome://tracing, Perfetto)
+        '''
+        self.prefix = prefix
+        self.tracing = tracing
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.events = []      # (name, start, end, scene, thread name, labels)
+        self.origin = time.perf_counter()
+
+    def __repr__(self):
+        return f"MetricsRegistry counters={len(self.counters)}, histograms={len(self.histograms)}, spans={len(self.events)}"
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.events = []
+            self.origin = time.perf_counter()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        '''
+        Context manager which observes its duration in seconds to histogram name
+        '''
+        return _Timer(self, name, labels)
+
+    def scene(self, sceneId):
+        '''
+        Context manager, spans of the current thread inside it belong to scene sceneId
+        '''
+        return _SceneContext(self, sceneId)
+
+    def current_scene(self):
+        return getattr(self.local, "scene", None)
+
+    def span(self, name, start, end, scene=None, **labels):
+        '''
+        Record span for trace, start and end are time.perf_counter() values
+        '''
+        if not self.tracing:
+            return
+        if scene is None:
+            scene = self.current_scene()
+        with self.lock:
+            self.events.append((name, start, end, scene, threading.current_thread().name, labels))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "histograms": [dict(name=name, labels=dict(labels), **histogram.to_dict())
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def to_prometheus(self):
+        '''
+        Returns: string in Prometheus text exposition format
+        '''
+        def format_labels(labels, extra=()):
+            items = [f'{key}="{_escape(value)}"' for key, value in list(labels) + list(extra)]
+            return "{" + ",".join(items) + "}" if items else ""
+
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            typed = set()
+            for (name, labels), value in counters:
+                if name not in typed:
+                    lines.append(f"# TYPE {self.prefix}{name} counter")
+                    typed.add(name)
+                lines.append(f"{self.prefix}{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in histograms:
+                if name not in typed:
+                    lines.append(f"# TYPE {self.prefix}{name} histogram")
+                    typed.add(name)
+                for bound, total in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.prefix}{name}_bucket{format_labels(labels, [('le', le)])} {total}")
+                lines.append(f"{self.prefix}{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{self.prefix}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_trace(self):
+        '''
+        Chrome trace-event JSON object, spans of each scene are in their own row so that stragglers stand out
+        '''
+        with self.lock:
+            events = list(self.events)
+        rows = {}
+        trace = []
+        for name, start, end, scene, thread, labels in events:
+            row = f"scene {scene}" if scene is not None else thread
+            if row not in rows:
+                rows[row] = len(rows) + 1
+                trace.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": rows[row],
+                              "args": {"name": row}})
+            trace.append({
+                "name": name,
+                "cat": name.split("_")[0],
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": rows[row],
+                "args": dict(labels, thread=thread),
+            })
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def save_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def save_prometheus(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_prometheus())
+
+    def save_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_trace(), f)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# registry shared by all modules of the client
+metrics = MetricsRegistry()
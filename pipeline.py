@@ -0,0 +1,286 @@
+import os
+import re
+import zlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ragnar import GetImage, TiledGetImage
+from kraken import Kraken
+from task_in_progress import StatusPoller
+from cache import hash_key
+from metrics import metrics
+from image_writer import write_image
+from clipping import ExtentClipper
+from spaceknow_tools import EPSGTransformator, TileFetcher
+
+
+# BGR colours of detections of map types, other map types get colour from PALETTE
+MAP_COLORS = {
+    "cars": (255, 0, 0),
+    "aircraft": (0, 0, 255),
+    "containers": (0, 255, 255),
+    "boats": (0, 255, 0),
+    "ships": (255, 255, 0),
+}
+PALETTE = [(255, 0, 255), (0, 128, 255), (255, 128, 0), (128, 0, 255), (0, 255, 128), (255, 255, 255)]
+
+
+def map_color(map_type):
+    if map_type in MAP_COLORS:
+        return MAP_COLORS[map_type]
+    return PALETTE[zlib.crc32(map_type.encode("utf-8")) % len(PALETTE)]
+
+
+def initiate_or_resume(job, journal):
+    '''
+    Resume pipeline of job from journal or initiate new one and record it
+    '''
+    tiles = getattr(job, "tiles", None)
+    if tiles is not None:
+        # TiledGetImage
+        for tile in tiles:
+            initiate_or_resume(tile, journal)
+        job.update_status()
+        return
+    if not journal.resume(job):
+        job.initiate()
+        journal.record(job)
+
+
+def initiate_job(job, journal=None):
+    '''
+    Initiate job (Kraken, GetImage, ...) or resume its pipeline from journal
+    Returns: job
+    '''
+    with metrics.scene(getattr(job, "sceneId", None)), metrics.timer("task_initiate_seconds", job=type(job).__name__):
+        if journal is None:
+            job.initiate()
+        else:
+            initiate_or_resume(job, journal)
+    return job
+
+
+def finish_job(job, poller=None, journal=None):
+    '''
+    Wait till initiated job is done and retrieve its result
+    Returns: job
+    '''
+    name = type(job).__name__
+    with metrics.scene(getattr(job, "sceneId", None)):
+        job.wait_till_job_is_done(poller=poller)
+        if journal is not None:
+            for tile in getattr(job, "tiles", [job]):
+                journal.record(tile)
+        if job.status == "RESOLVED":
+            with metrics.timer("task_retrieve_seconds", job=name):
+                job.retrieve()
+    return job
+
+
+def run_job(job, poller=None, journal=None):
+    '''
+    Initiate job (Kraken, GetImage, ...), wait till it is done and retrieve its result
+    Args:
+        job (TaskInProgress): job to run
+        poller (StatusPoller): shared poller of job status
+        journal (PipelineJournal): journal of pipelines, pipelines in it are resumed instead of initiated
+    Returns: job
+    '''
+    initiate_job(job, journal)
+    return finish_job(job, poller, journal)
+
+
+def guarded(step, job, *args):
+    '''
+    Run step (e.g. run_job) of job, error of the job makes it FAILED instead of stopping the other jobs
+    Returns: job
+    '''
+    try:
+        return step(job, *args)
+    except Exception:
+        print(f"{type(job).__name__} of scene {getattr(job, 'sceneId', None)} failed")
+        traceback.print_exc()
+        job.status = "FAILED"
+        return job
+
+
+def make_getimage(metadata, extent, headers, cache=None, client=None, image_tile_size=None, streaming=False,
+                  mmap_dir=None):
+    '''
+    GetImage of scene, large extent is split to tiles of image_tile_size pixels (see TiledGetImage),
+    tiles are always streamed. streaming and mmap_dir are passed to GetImage, see its arguments
+    '''
+    if image_tile_size is None:
+        return GetImage(sceneId=metadata.sceneId, extent=extent, headers=headers, cache=cache, client=client,
+                        streaming=streaming, mmap_dir=mmap_dir)
+    return TiledGetImage(metadata, extent, tile_size=image_tile_size, headers=headers, cache=cache, client=client)
+
+
+def scene_key(metadata, extent, map_types=("cars",)):
+    return hash_key("scene", metadata.sceneId, extent, ",".join(map_types))
+
+
+def render_features(metadata, detections, rgb_image, band, img_prefix="", writer=None, output_dir=None):
+    '''
+    Draw detections of all map types to image, each with its own colour (see map_color), and save it
+    Args:
+        metadata (Metadata): scene of image
+        detections (dict): map type -> DetectionStore with detections in WGS84
+        rgb_image (np.array): image of scene
+        band (dict): band from meta of GetImage with crsOriginX/Y and pixelSizeX/Y of rgb_image
+        img_prefix (string): prefix of name of image file
+        writer (ImageWriter): writer of images in background, PNG is written synchronously if None
+        output_dir (string): directory of image file, current directory if None
+    Returns: name of saved image file, it is written asynchronously if writer is set
+    '''
+    crsOriginXY = band["crsOriginX"], band["crsOriginY"]
+    pixelSizeXY = band["pixelSizeX"], band["pixelSizeY"]
+
+    trans = EPSGTransformator(metadata.crsEpsg)
+    with metrics.scene(metadata.sceneId), metrics.timer("render_seconds", stage="draw"):
+        for map_type, store in detections.items():
+            store.transform(trans).draw(rgb_image, crsOriginXY, pixelSizeXY, map_color(map_type))
+
+    # print result depends on shoot time
+    extension = writer.extension if writer is not None else ".png"
+    img_file = img_prefix + metadata.datetime + "_" + metadata.satellite + extension
+    img_file = re.sub('[^-a-zA-Z0-9_.()]+', '_', img_file)
+    if output_dir is not None:
+        img_file = os.path.join(output_dir, img_file)
+    print(metadata.datetime, metadata.satellite)
+    if writer is not None:
+        writer.submit(img_file, rgb_image, band, metadata.crsEpsg)
+        print(f"Image is being saved to {img_file}")
+        return img_file
+    with metrics.scene(metadata.sceneId), metrics.timer("render_seconds", stage="encode"):
+        write_image(img_file, rgb_image)
+    print(f"Image saved to {img_file}")
+    return img_file
+
+
+def count_summary(map_type, kraken):
+    '''
+    Number of detections of kraken with numbers of detections in tiles, inside extent and removed duplicates
+    '''
+    parts = [f"{kraken.raw_count} in tiles"]
+    if kraken.clipper is not None:
+        inside = kraken.deduplicator.raw_count if kraken.deduplicator else len(kraken.detections)
+        parts.append(f"{inside} inside extent")
+    if kraken.deduplicator:
+        parts.append(f"{kraken.deduplicator.raw_count - kraken.deduplicator.count} duplicates removed")
+    return f"Number of {map_type} is {len(kraken.detections)} ({', '.join(parts)})"
+
+
+def render_scene(metadata, krakens, getimage, writer=None, output_dir=None):
+    '''
+    Draw detections from krakens to image from getimage and save it
+    Args:
+        krakens (dict): map type -> Kraken of scene
+        writer (ImageWriter): writer of images in background
+        output_dir (string): directory of image file
+    Returns: name of saved image file
+    '''
+    detections = {map_type: kraken.detections for map_type, kraken in krakens.items()}
+    img_file = render_features(metadata, detections, getimage.skimage.imageRGB, getimage.meta["bands"][0],
+                               writer=writer, output_dir=output_dir)
+    for map_type, kraken in krakens.items():
+        print(count_summary(map_type, kraken))
+    return img_file
+
+
+def run_scenes(scenes, extent, headers, max_concurrency=8, max_polls_per_second=5.0, tile_fetcher=None, cache=None,
+               client=None, image_tile_size=None, journal=None, map_types=("cars",), streaming=False, mmap_dir=None,
+               writer=None, timeseries=None, clip="centroid", output_dir=None, density=None, images=True):
+    '''
+    Run Kraken of each map type and one GetImage of all scenes concurrently, each scene is rendered
+    as soon as all its jobs are done. Pipelines of all jobs are initiated first, only waiting for them
+    and retrieving their results is limited by max_concurrency. Failed job skips only its scene.
+    Args:
+        scenes (list of Metadata): results of SearchScene
+        extent (object): area of interest
+        headers (dict): headers with authorization
+        max_concurrency (int): maximal number of jobs polled and retrieved at once
+        max_polls_per_second (float): maximal rate of status requests of all jobs together
+        tile_fetcher (TileFetcher): downloader of detection tiles shared by all scenes
+        cache (DiskCache): cache of Kraken results and images
+        client (SpaceKnowClient): shared HTTP client
+        image_tile_size (int): if set, images are requested in tiles of this size in pixels
+        streaming (bool): spool *.ski files to disk and decode bands lazily
+        mmap_dir (string): directory where bands of images are decoded into memory-mapped files
+        journal (PipelineJournal): journal of pipelines and outputs, scenes with output in it are skipped
+        map_types (list of string): map types of Kraken, detections of all of them are drawn to one image
+        writer (ImageWriter): writer of images in background, images are written synchronously if None
+        timeseries (TimeSeriesStore): store where results of scenes are recorded
+        clip (string): detections outside extent are dropped, see modes of ExtentClipper, None keeps all
+        output_dir (string): directory of saved images, current directory if None
+        density (DensityGrid): grid to which detections of each scene are added
+        images (bool): run GetImage and save image of each scene, only detections are retrieved if False
+    Returns: list of names of saved image files
+    '''
+    img_files = []
+    if tile_fetcher is None:
+        tile_fetcher = TileFetcher(session=client, cache=cache)
+    clipper = ExtentClipper(extent, clip) if clip is not None else None
+    with StatusPoller(max_polls_per_second) as poller, ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        jobs = {}
+        remaining = {}
+        for metadata in scenes:
+            stored_file = None
+            if images and journal is not None:
+                stored_file = journal.output(scene_key(metadata, extent, map_types))
+            if stored_file is not None:
+                print(f"Scene {metadata.sceneId} is already done: {stored_file}")
+                img_files.append(stored_file)
+                if timeseries is None or timeseries.is_done(extent, metadata, map_types):
+                    continue
+            krakens = {map_type: Kraken(metadata.sceneId, extent, map_type, headers, tile_fetcher=tile_fetcher,
+                                        cache=cache, client=client, keep_features=False, clipper=clipper)
+                       for map_type in map_types}
+            getimage = None
+            if images and stored_file is None:
+                getimage = make_getimage(metadata, extent, headers, cache, client, image_tile_size, streaming, mmap_dir)
+            # jobs of one scene are submitted together, so the scene takes as long as its slowest job
+            scene_jobs = ([getimage] if getimage is not None else []) + list(krakens.values())
+            remaining[metadata.sceneId] = len(scene_jobs)
+            for job in scene_jobs:
+                jobs[job] = (metadata, krakens, getimage, stored_file)
+
+        # initiations are queued before any waiting, so all pipelines run on server at once
+        initiated = [executor.submit(guarded, initiate_job, job, journal) for job in jobs]
+        pending = [executor.submit(guarded, finish_job, future.result(), poller, journal)
+                   for future in as_completed(initiated)]
+
+        for future in as_completed(pending):
+            metadata, krakens, getimage, stored_file = jobs[future.result()]
+            remaining[metadata.sceneId] -= 1
+            if remaining[metadata.sceneId] > 0:
+                continue
+            if ((getimage is None or getimage.status == "RESOLVED")
+                    and all(kraken.status == "RESOLVED" for kraken in krakens.values())):
+                detections = {map_type: kraken.detections for map_type, kraken in krakens.items()}
+                # scene whose image is in journal is only recorded to timeseries with the stored image
+                img_file = stored_file
+                if getimage is not None:
+                    img_file = render_scene(metadata, krakens, getimage, writer, output_dir)
+                    img_files.append(img_file)
+                    if journal is not None:
+                        journal.record_output(scene_key(metadata, extent, map_types), img_file)
+                elif stored_file is None:
+                    print(metadata.datetime, metadata.satellite)
+                    for map_type, kraken in krakens.items():
+                        print(count_summary(map_type, kraken))
+                if density is not None:
+                    with metrics.scene(metadata.sceneId), metrics.timer("density_seconds"):
+                        density.add(metadata, detections)
+                if timeseries is not None:
+                    timeseries.record(extent, metadata, detections, img_file)
+            else:
+                if timeseries is not None:
+                    timeseries.record_failure(extent, metadata)
+                statuses = ", ".join(f"Kraken {map_type} is {kraken.status}" for map_type, kraken in krakens.items())
+                if getimage is not None:
+                    statuses += f", GetImage is {getimage.status}"
+                print(f"Scene {metadata.sceneId} skipped, {statuses}")
+            if getimage is not None:
+                # image was drawn and handed to writer, its temporary files are not needed
+                getimage.close()
+    return img_files
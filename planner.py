@@ -0,0 +1,196 @@
+import math
+from datetime import datetime, timedelta
+import numpy as np
+import cv2
+from spaceknow_tools import geometry_bounds, geometry_polygons
+
+BUCKETS = ["day", "week", "month", "year"]
+
+
+def parse_datetime(value):
+    '''
+    Parse datetime of scene, format is YYYY-MM-DD HH:MM:SS (ISO format is accepted too)
+    '''
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+
+def time_bucket(value, bucket):
+    if bucket == "day":
+        return value.strftime("%Y-%m-%d")
+    if bucket == "week":
+        year, week, _ = value.isocalendar()
+        return f"{year}-W{week:02d}"
+    if bucket == "month":
+        return value.strftime("%Y-%m")
+    return value.strftime("%Y")
+
+def bucket_start(value, bucket):
+    '''
+    Start of the time bucket containing value, weeks start on Monday as in time_bucket
+    '''
+    value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == "week":
+        return value - timedelta(days=value.weekday())
+    if bucket == "month":
+        return value.replace(day=1)
+    if bucket == "year":
+        return value.replace(month=1, day=1)
+    return value
+
+def intersection_ratio(footprint, extent, grid_size=256):
+    '''
+    Part of extent covered by footprint, both are rasterized on a grid over bounding box of extent
+    Args:
+        footprint (object): GeoJSON geometry of scene
+        extent (object): GeoJSON geometry of area of interest
+        grid_size (int): resolution of the grid
+    Returns: float between 0 and 1
+    '''
+    bounds = geometry_bounds(extent)
+    if bounds is None:
+        return 0.0
+    minx, miny, maxx, maxy = bounds
+    scale = np.array([grid_size / max(maxx - minx, 1e-12), grid_size / max(maxy - miny, 1e-12)])
+
+    def rasterize(geometry):
+        mask = np.zeros((grid_size, grid_size), dtype=np.uint8)
+        polygons = [np.round((np.array(ring, dtype=np.float64)[:, :2] - (minx, miny)) * scale).astype(np.int32)
+                    for ring, *_ in geometry_polygons(geometry) if len(ring) > 0]
+        if polygons:
+            cv2.fillPoly(mask, polygons, 1)
+        return mask
+
+    extent_mask = rasterize(extent)
+    extent_area = np.count_nonzero(extent_mask)
+    if extent_area == 0:
+        return 0.0
+    return np.count_nonzero(extent_mask & rasterize(footprint)) / extent_area
+
+
+class ScenePlanner:
+    def __init__(self, max_cloud_cover=None, max_off_nadir=None, min_sun_elevation=None, max_anomalous_ratio=None,
+                 min_intersection=None, best_per_bucket=None, bucket="day", duplicate_minutes=None):
+        '''
+        Filter and rank scenes from SearchScene before expensive Kraken and GetImage jobs are started
+        Args:
+            max_cloud_cover (float): maximal cloudCover, 0..1
+            max_off_nadir (float): maximal absolute offNadir in degrees
+            min_sun_elevation (float): minimal sunElevation in degrees
+            max_anomalous_ratio (float): maximal anomalousRatio, 0..1
+            min_intersection (float): minimal part of extent covered by footprint, 0..1
+            best_per_bucket (int): keep only N best scenes in each time bucket
+            bucket (string): day, week, month or year
+            duplicate_minutes (float): scenes of the same satellite acquired within this time are duplicates,
+                only the best one is kept
+        '''
+        if bucket not in BUCKETS:
+            raise ValueError(f"unknown bucket {bucket}")
+        self.max_cloud_cover = max_cloud_cover
+        self.max_off_nadir = max_off_nadir
+        self.min_sun_elevation = min_sun_elevation
+        self.max_anomalous_ratio = max_anomalous_ratio
+        self.min_intersection = min_intersection
+        self.best_per_bucket = best_per_bucket
+        self.bucket = bucket
+        self.duplicate_minutes = duplicate_minutes
+
+    def score(self, metadata, intersection):
+        '''
+        Quality of scene, higher is better
+        '''
+        score = intersection
+        if metadata.cloudCover is not None:
+            score *= 1.0 - metadata.cloudCover
+        if metadata.offNadir is not None:
+            score *= math.cos(math.radians(min(abs(metadata.offNadir), 89.0)))
+        if metadata.sunElevation is not None:
+            score *= math.sin(math.radians(max(metadata.sunElevation, 1.0)))
+        if metadata.anomalousRatio is not None:
+            score *= 1.0 - metadata.anomalousRatio
+        return score
+
+    def rejection(self, metadata, intersection):
+        '''
+        Returns: reason why scene is rejected by thresholds, None if it passes
+        '''
+        if self.max_cloud_cover is not None and metadata.cloudCover is not None \
+                and metadata.cloudCover > self.max_cloud_cover:
+            return f"cloudCover {metadata.cloudCover:.2f} > {self.max_cloud_cover}"
+        if self.max_off_nadir is not None and metadata.offNadir is not None \
+                and abs(metadata.offNadir) > self.max_off_nadir:
+            return f"offNadir {abs(metadata.offNadir):.1f} > {self.max_off_nadir}"
+        if self.min_sun_elevation is not None and metadata.sunElevation is not None \
+                and metadata.sunElevation < self.min_sun_elevation:
+            return f"sunElevation {metadata.sunElevation:.1f} < {self.min_sun_elevation}"
+        if self.max_anomalous_ratio is not None and metadata.anomalousRatio is not None \
+                and metadata.anomalousRatio > self.max_anomalous_ratio:
+            return f"anomalousRatio {metadata.anomalousRatio:.2f} > {self.max_anomalous_ratio}"
+        if self.min_intersection is not None and intersection < self.min_intersection:
+            return f"intersection {intersection:.2f} < {self.min_intersection}"
+        return None
+
+    def plan(self, scenes, extent):
+        '''
+        Args:
+            scenes (list of Metadata): results of SearchScene
+            extent (object): area of interest
+        Returns: tuple (list of selected Metadata sorted by datetime, list of tuples (rejected Metadata, reason))
+        '''
+        candidates = []
+        rejected = []
+        for metadata in scenes:
+            intersection = intersection_ratio(metadata.footprint, extent) if metadata.footprint else 1.0
+            reason = self.rejection(metadata, intersection)
+            if reason is None:
+                candidates.append((self.score(metadata, intersection), parse_datetime(metadata.datetime), metadata))
+            else:
+                rejected.append((metadata, reason))
+        # the best scenes first, so duplicates and full buckets reject the worse ones
+        candidates.sort(key=lambda candidate: -candidate[0])
+
+        selected = []
+        buckets = {}
+        for score, acquired, metadata in candidates:
+            if self.duplicate_minutes is not None:
+                duplicate = next((other for _, other_acquired, other in selected
+                                  if other.satellite == metadata.satellite
+                                  and abs((acquired - other_acquired).total_seconds()) <= self.duplicate_minutes * 60), None)
+                if duplicate is not None:
+                    rejected.append((metadata, f"duplicate of {duplicate.sceneId}"))
+                    continue
+            if self.best_per_bucket is not None:
+                bucket = time_bucket(acquired, self.bucket)
+                if buckets.get(bucket, 0) >= self.best_per_bucket:
+                    rejected.append((metadata, f"not among {self.best_per_bucket} best of {self.bucket} {bucket}"))
+                    continue
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+            selected.append((score, acquired, metadata))
+        selected.sort(key=lambda candidate: candidate[1])
+        return [metadata for _, _, metadata in selected], rejected
+
+    def search_start(self, watermark):
+        '''
+        Start of search of scenes new since watermark (see TimeSeriesStore.watermark). It is moved back to the start
+        of bucket of watermark and by duplicate_minutes, so the scenes processed before are planned with the new ones
+        Returns: datetime string, None if watermark is None
+        '''
+        if watermark is None:
+            return None
+        start = parse_datetime(watermark)
+        if self.best_per_bucket is not None:
+            start = bucket_start(start, self.bucket)
+        if self.duplicate_minutes is not None:
+            start -= timedelta(minutes=self.duplicate_minutes)
+        return start.strftime("%Y-%m-%d %H:%M:%S")
+
+    def report(self, selected, rejected):
+        '''
+        Print which scenes would be processed and why the others are not
+        '''
+        print(f"{len(selected)} scenes selected, {len(rejected)} rejected")
+        for metadata in selected:
+            print(f"  + {metadata.datetime} {metadata.satellite} {metadata.sceneId}")
+        for metadata, reason in sorted(rejected, key=lambda r: r[0].datetime):
+            print(f"  - {metadata.datetime} {metadata.satellite} {metadata.sceneId}: {reason}")
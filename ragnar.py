@@ -1,21 +1,31 @@
 import json
-import requests
 import wget
 import os
+import shutil
+import tempfile
 from io import BytesIO
 import tarfile
 import struct
+from datetime import datetime
 import numpy as np
 import cv2
+import geojson
+from concurrent.futures import ThreadPoolExecutor
 from urllib.request import urlopen
-from task_in_progress import TaskInProgress
-from spaceknow_tools import SatelliteImagery, Metadata, Band
+from task_in_progress import TaskInProgress, PollingBackoff
+from spaceknow_tools import SatelliteImagery, Metadata, Band, EPSGTransformator, geometry_bounds, to_pixels
+from cache import search_key, image_key, image_meta_key
+from metrics import metrics
+from planner import parse_datetime
 
 URL = "https://spaceknow-imagery.appspot.com"
 
 
 class SearchScene(TaskInProgress):
-    def __init__(self, satelite_imagery, extent, startDatetime=None, endDatetime=None, minIntersection=None, headers={"content-type": "application/json"}):
+    backoff = PollingBackoff(initial=1.0, maximum=5.0)
+
+    def __init__(self, satelite_imagery, extent, startDatetime=None, endDatetime=None, minIntersection=None, headers={"content-type": "application/json"},
+                 cache=None, client=None):
         '''
         Args:
             satelite_imagery(SatelliteImagery): contains provider and dataset for scene request
@@ -23,6 +33,9 @@ class SearchScene(TaskInProgress):
             startDatetime (string): UTC date-time filter in format YYYY-MM-DD HH:MM:SS
             endDatetime (string): UTC date-time filter in format YYYY-MM-DD HH:MM:SS
             minIntersection (float): a number between 0 and 1 (0≤i≤1). 0 means arbitrarily but still present intersection.
+            cache (DiskCache): cache of search results, search is not initiated on cache hit. Only searches
+                with endDatetime in the past are cached, results of open-ended search change with new scenes
+            client (SpaceKnowClient): shared HTTP client, headers are not used if it is set
         '''
         self.satelite_imagery = satelite_imagery
         self.extent = extent
@@ -30,11 +43,21 @@ class SearchScene(TaskInProgress):
         self.endDatetime = endDatetime
         self.minIntersection = minIntersection
         self.headers = headers
+        self.client = client
         self.results = []
         self.pipelineId = None
         self.status = None
+        self.cache = cache if endDatetime is not None and parse_datetime(endDatetime) < datetime.utcnow() else None
+        self.cache_key = search_key(satelite_imagery, extent, startDatetime, endDatetime, minIntersection)
+        self.cached_results = None
 
     def initiate(self):
+        if self.cache is not None:
+            self.cached_results = self.cache.get_json(self.cache_key)
+            if self.cached_results is not None:
+                self.status = "RESOLVED"
+                return self.status, self.pipelineId
+
         payload = {
             "provider": self.satelite_imagery.provider,
             "dataset": self.satelite_imagery.dataset,
@@ -47,10 +70,7 @@ class SearchScene(TaskInProgress):
         if self.minIntersection is not None:
             payload["minIntersection"] = self.minIntersection
 
-        response = requests.post(
-            URL + "/imagery/search/initiate",
-            headers=self.headers,
-            data=json.dumps(payload))
+        response = self.post(URL + "/imagery/search/initiate", payload)
         if response.status_code == 200:
             response_json = response.json()
             self.pipelineId = response_json["pipelineId"]
@@ -62,16 +82,18 @@ class SearchScene(TaskInProgress):
         return self.status, self.pipelineId
 
     def retrieve(self):
+        if self.cached_results is not None:
+            self.results = [Metadata.fromDictData(result) for result in self.cached_results]
+            return
         payload = {
             "pipelineId": self.pipelineId
         }
-        response = requests.post(
-            URL + "/imagery/search/retrieve",
-            headers=self.headers,
-            data=json.dumps(payload))
+        response = self.post(URL + "/imagery/search/retrieve", payload)
         if response.status_code == 200:
             response_json = response.json()
             self.results = [Metadata.fromDictData(result) for result in response_json["results"]]
+            if self.cache is not None:
+                self.cache.put_json(self.cache_key, response_json["results"])
         else:
             print(response.status_code)
             print(response.json())
@@ -87,69 +109,367 @@ class SKImage:
         64: np.uint64,
         65: np.int64,
     }
-    def __init__(self, fileobj):
+    # channels of imageRGB in order of OpenCV
+    rgb_names = ("blue", "green", "red")
+    # approximate number of pixels of subsample used for percentiles of display stretch
+    stretch_sample = 1 << 18
+
+    def __init__(self, fileobj, lazy=False, mmap_dir=None, stretch=(2.0, 98.0)):
         '''
         Driver to use *.ski file (actually *.tar.gz) that include info.json, meta.json and 0000x.skb
         Args:
-            ski_file (tarfile): handler to opened file, handler has methods read()
-
+            ski_file (tarfile): handler to opened file, handler has methods read() and seek()
+            lazy (bool): decode band when it is accessed for the first time, fileobj must stay open
+            mmap_dir (string): directory where bands are decoded into memory-mapped *.npy files, each image
+                has its own unique files and they are removed by close
+            stretch (tuple of float): low and high percentile of values of each channel mapped to 0 and 255
+                in imageRGB, None maps the whole range of bit depth
         '''
-        tfile = tarfile.open(fileobj=fileobj)
-        ski_info = tfile.extractfile("info.json").read()
-        ski_info = json.loads(ski_info)
-        ski_meta = tfile.extractfile("meta.json").read()
+        self.fileobj = fileobj
+        self.mmap_dir = mmap_dir
+        self.mmap_files = []
+        self.stretch = stretch
+        self.tfile = tarfile.open(fileobj=fileobj)
+        ski_info = self.tfile.extractfile("info.json").read()
+        self.info = json.loads(ski_info)
+        ski_meta = self.tfile.extractfile("meta.json").read()
         ski_meta = json.loads(ski_meta)
         self.metadata = ski_meta
 
-        img_channels = {}
-        for index, band in enumerate(ski_info["bands"]):
-            skband_file = tfile.extractfile(str(index).zfill(5) + ".skb")
-
-            img = self.parse_skband_file(skband_file)
-            img_channels.setdefault(band["names"][0], img)
-            #if band["names"][0].find("MASK") >= 0:
-            #    cv2.imshow(band["names"][0], 100*img.astype(np.uint8))
-            #else:
-            #    cv2.imshow(band["names"][0], img.astype(np.uint8))
-            #cv2.waitKey(1)
-
-        self.imageRGB = np.stack((img_channels["blue"], img_channels["green"], img_channels["red"]), axis=2)
-        self.imageRGB = self.imageRGB.astype(np.uint8)
-
-    def parse_skband_file(self, skband_file):
-        data_type_idx = struct.unpack("<H", skband_file.read(2))[0]
-        data_type = self.data_type_dict.get(data_type_idx)
-        num_columns = struct.unpack("<I", skband_file.read(4))[0]
-        num_rows = struct.unpack("<I", skband_file.read(4))[0]
-        bitdepth = data_type_idx & ~0x01
+        # the first band of given name wins
+        self.band_indexes = {}
+        for index, band in enumerate(self.info["bands"]):
+            self.band_indexes.setdefault(band["names"][0], index)
+        self.bands = {}
+        self._rgb_planes = None
+        self._imageRGB = None
+
+        if not lazy:
+            if all(name in self.band_indexes for name in self.rgb_names):
+                self.rgb_planes()
+            for name in self.band_indexes:
+                self.band(name)
+            self.close_archive()
+
+    def open_memmap(self, data_type, shape):
+        '''
+        New memory-mapped *.npy file in mmap_dir, the file is removed by close
+        '''
+        fd, path = tempfile.mkstemp(dir=self.mmap_dir, prefix="skimage", suffix=".npy")
+        os.close(fd)
+        self.mmap_files.append(path)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=data_type, shape=shape)
+
+    def skband_file(self, name):
+        if self.tfile is None:
+            raise ValueError(f"Band {name} was not decoded and *.ski file is already closed")
+        return self.tfile.extractfile(str(self.band_indexes[name]).zfill(5) + ".skb")
+
+    def decode(self, name, skband_file, out=None):
+        with metrics.timer("band_decode_seconds", band=name):
+            band = self.parse_skband_file(skband_file, out)
+        metrics.inc("band_decoded_bytes_total", band.nbytes)
+        return band
+
+    def band(self, name):
+        '''
+        Decoded band, it is decoded on the first access
+        Args:
+            name (string): name of band, e.g. "red"
+        Returns: np.array (or np.memmap if mmap_dir is set) with shape (num_rows, num_columns)
+        '''
+        if name not in self.bands:
+            skband_file = self.skband_file(name)
+            out = None
+            if self.mmap_dir is not None:
+                data_type, num_columns, num_rows = self.read_skband_header(skband_file)
+                skband_file.seek(0)
+                out = self.open_memmap(data_type, (num_rows, num_columns))
+            self.bands[name] = self.decode(name, skband_file, out)
+        return self.bands[name]
+
+    def rgb_planes(self):
+        '''
+        Blue, green and red bands decoded straight into channels of one array, bands of them are its views
+        Returns: np.array with shape (num_rows, num_columns, 3) and data type of bands
+        '''
+        if self._rgb_planes is None:
+            headers = {}
+            for name in self.rgb_names:
+                if name in self.bands:
+                    headers[name] = (self.bands[name].dtype, self.bands[name].shape)
+                else:
+                    skband_file = self.skband_file(name)
+                    data_type, num_columns, num_rows = self.read_skband_header(skband_file)
+                    headers[name] = (np.dtype(data_type), (num_rows, num_columns))
+            if len(set(headers.values())) != 1:
+                raise ValueError(f"Bands {', '.join(self.rgb_names)} differ in data type or shape: {headers}")
+            data_type, shape = headers[self.rgb_names[0]]
+            if self.mmap_dir is not None:
+                planes = self.open_memmap(data_type, shape + (3,))
+            else:
+                planes = np.empty(shape + (3,), dtype=data_type)
+            for channel, name in enumerate(self.rgb_names):
+                if name in self.bands:
+                    planes[:, :, channel] = self.bands[name]
+                else:
+                    self.decode(name, self.skband_file(name), planes[:, :, channel])
+                self.bands[name] = planes[:, :, channel]
+            self._rgb_planes = planes
+        return self._rgb_planes
+
+    def bit_depth(self, name):
+        band = self.info["bands"][self.band_indexes[name]]
+        return band.get("bitDepth") or 8 * self.band(name).dtype.itemsize
+
+    def display_range(self, planes):
+        '''
+        Values of each channel mapped to 0 and 255, percentiles are computed on subsample of pixels
+        Returns: tuple (np.array low, np.array high), both with shape (3,)
+        '''
+        max_value = float((1 << max(self.bit_depth(name) for name in self.rgb_names)) - 1)
+        if self.stretch is None:
+            return np.zeros(3), np.full(3, max_value)
+        num_rows, num_columns = planes.shape[:2]
+        step = max(1, int(np.sqrt(num_rows * num_columns / self.stretch_sample)))
+        sample = planes[::step, ::step].reshape(-1, 3)
+        low, high = np.percentile(sample, self.stretch, axis=0)
+        low = np.clip(low, 0.0, max_value)
+        high = np.maximum(np.clip(high, 0.0, max_value), low + 1.0)
+        return low, high
+
+    @property
+    def imageRGB(self):
+        '''
+        BGR uint8 image for display, see display_range
+        '''
+        if self._imageRGB is None:
+            planes = self.rgb_planes()
+            if planes.dtype == np.uint8 and self.stretch is None:
+                self._imageRGB = planes
+            else:
+                low, high = self.display_range(planes)
+                self._imageRGB = to_uint8(planes, low, high)
+        return self._imageRGB
+
+    def calibration(self, name, kind="reflectance", band=None):
+        '''
+        Calibration coefficients of band
+        Args:
+            name (string): name of band
+            kind (string): radiance or reflectance
+            band (Band): band from Metadata, coefficients from info.json of *.ski are used if None
+        Returns: tuple (mult, add)
+        '''
+        assert kind in ["radiance", "reflectance"]
+        if band is not None:
+            return getattr(band, kind + "Mult"), getattr(band, kind + "Add")
+        info = self.info["bands"][self.band_indexes[name]]
+        mult = info.get(kind + "Mult")
+        add = info.get(kind + "Add")
+        return 1.0 if mult is None else mult, 0.0 if add is None else add
+
+    def calibrated(self, name, kind="reflectance", band=None):
+        '''
+        Band in physical units, mult * value + add
+        Returns: float32 np.array
+        '''
+        mult, add = self.calibration(name, kind, band)
+        raw = self.band(name)
+        out = np.empty(raw.shape, dtype=np.float32)
+        np.multiply(raw, np.float32(mult), out=out)
+        out += np.float32(add)
+        return out
+
+    def calibrated_rgb(self, kind="reflectance", bands=None):
+        '''
+        Blue, green and red channels in physical units
+        Args:
+            kind (string): radiance or reflectance
+            bands (list of Band): bands of Metadata, coefficients from info.json of *.ski are used if None
+        Returns: float32 np.array with shape (num_rows, num_columns, 3)
+        '''
+        bands = {band.names[0]: band for band in bands} if bands is not None else {}
+        coefficients = np.array([self.calibration(name, kind, bands.get(name)) for name in self.rgb_names],
+                                dtype=np.float32)
+        planes = self.rgb_planes()
+        out = np.empty(planes.shape, dtype=np.float32)
+        np.multiply(planes, coefficients[:, 0], out=out)
+        out += coefficients[:, 1]
+        return out
+
+    def close_archive(self):
+        '''
+        Close *.ski file, bands which were already decoded stay available
+        '''
+        if self.tfile is not None:
+            self.tfile.close()
+            self.tfile = None
+            self.fileobj.close()
+
+    def close(self):
+        '''
+        Close *.ski file, release decoded bands and remove their memory-mapped files
+        '''
+        self.close_archive()
+        self.bands = {}
+        self._rgb_planes = None
+        self._imageRGB = None
+        for path in self.mmap_files:
+            # memory maps still referenced elsewhere stay valid, the file is freed when they are released
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.mmap_files = []
+
+    @classmethod
+    def read_skband_header(cls, skband_file):
+        '''
+        Read header of *.skb file: data type (uint16), number of columns (uint32) and number of rows (uint32)
+        Args:
+            skband_file (file): handler to opened *.skb file, positioned at the beginning
+        Returns: tuple (data_type, num_columns, num_rows)
+        '''
+        data_type_idx, num_columns, num_rows = struct.unpack("<HII", skband_file.read(10))
+        data_type = cls.data_type_dict.get(data_type_idx)
+        if data_type is None:
+            raise ValueError(f"Unknown data type {data_type_idx} in skb file")
+        return data_type, num_columns, num_rows
+
+    @classmethod
+    def parse_skband_file(cls, skband_file, out=None):
+        '''
+        Decode *.skb band. Whole payload is read at once and delta-coded rows are reconstructed
+        by one cumulative sum in the band's data type, so overflow wraps the same way as row by row addition.
+        Args:
+            skband_file (file): handler to opened *.skb file
+            out (np.array): optional preallocated array of shape (num_rows, num_columns) to decode into
+        Returns: np.array with shape (num_rows, num_columns)
+        '''
+        data_type, num_columns, num_rows = cls.read_skband_header(skband_file)
+        if out is None:
+            out = np.empty((num_rows, num_columns), dtype=data_type)
+        elif out.shape != (num_rows, num_columns):
+            raise ValueError(f"Output array has shape {out.shape}, band has {(num_rows, num_columns)}")
+        file_dtype = np.dtype(data_type).newbyteorder("<")
+        num_bytes = num_rows * num_columns * file_dtype.itemsize
+        payload = skband_file.read(num_bytes)
+        if len(payload) != num_bytes:
+            raise ValueError(f"skb file is truncated, expected {num_bytes} bytes, got {len(payload)}")
+        deltas = np.frombuffer(payload, dtype=file_dtype).reshape(num_rows, num_columns)
+        np.cumsum(deltas, axis=0, dtype=data_type, out=out)
+        return out
+
+    @classmethod
+    def parse_skband_file_reference(cls, skband_file):
+        '''
+        Pure python decoder of *.skb band (row by row). Slow, kept as reference for parse_skband_file.
+        '''
+        data_type, num_columns, num_rows = cls.read_skband_header(skband_file)
+        itemsize = np.dtype(data_type).itemsize
+        mask = (1 << (8 * itemsize)) - 1
+        signed = np.issubdtype(data_type, np.signedinteger)
+        fmt = "<" + {1: "B", 2: "H", 4: "I", 8: "Q"}[itemsize] * num_columns
         ret = np.zeros((num_rows, num_columns), dtype=data_type)
-        num_bytes_in_row = num_columns * bitdepth//8
+        previous_row = [0] * num_columns
         for r in range(num_rows):
-            row_bytes = skband_file.read(num_bytes_in_row)
-            next_row = np.frombuffer(row_bytes, dtype=data_type)
-            if r == 0:
-                ret[r,:] = next_row
+            next_row = struct.unpack(fmt, skband_file.read(num_columns * itemsize))
+            previous_row = [(a + b) & mask for a, b in zip(previous_row, next_row)]
+            if signed:
+                ret[r, :] = [v - (mask + 1) if v > (mask >> 1) else v for v in previous_row]
             else:
-                ret[r,:] = ret[r-1,:] + next_row
-
+                ret[r, :] = previous_row
         return ret
 
+    @classmethod
+    def encode_skband(cls, image):
+        '''
+        Encode 2D array to *.skb format (header and delta-coded rows), inverse of parse_skband_file
+        Args:
+            image (np.array): 2D array with one of data types from data_type_dict
+        Returns: bytes
+        '''
+        data_type_idx = {np.dtype(v): k for k, v in cls.data_type_dict.items()}[image.dtype]
+        num_rows, num_columns = image.shape
+        deltas = np.empty_like(image)
+        if num_rows > 0:
+            deltas[0] = image[0]
+            np.subtract(image[1:], image[:-1], out=deltas[1:])
+        header = struct.pack("<HII", data_type_idx, num_columns, num_rows)
+        return header + deltas.astype(image.dtype.newbyteorder("<"), copy=False).tobytes()
+
+def to_uint8(planes, low, high):
+    '''
+    Scale channels linearly so that low is 0 and high is 255, values outside are clipped
+    Args:
+        planes (np.array): image with shape (num_rows, num_columns, num_channels)
+        low (np.array): value mapped to 0 of each channel
+        high (np.array): value mapped to 255 of each channel
+    Returns: uint8 np.array with the same shape
+    '''
+    out = np.empty(planes.shape, dtype=np.uint8)
+    scale = 255.0 / (np.asarray(high, dtype=np.float64) - low)
+    if planes.dtype.kind == "u" and planes.dtype.itemsize <= 2:
+        # lookup table of all values of data type, no float copy of image
+        values = np.arange(1 << (8 * planes.dtype.itemsize), dtype=np.float64)
+        for channel in range(planes.shape[2]):
+            lut = np.clip(np.rint((values - low[channel]) * scale[channel]), 0, 255).astype(np.uint8)
+            np.take(lut, planes[:, :, channel], out=out[:, :, channel], mode="clip")
+        return out
+    # float conversion in blocks of rows to bound size of temporary array
+    block_rows = max(1, (1 << 22) // max(1, planes.shape[1] * planes.shape[2]))
+    low = np.asarray(low, dtype=np.float32)
+    scale = scale.astype(np.float32)
+    for start in range(0, planes.shape[0], block_rows):
+        block = planes[start:start + block_rows].astype(np.float32)
+        block -= low
+        block *= scale
+        np.clip(block, 0, 255, out=block)
+        out[start:start + block_rows] = np.rint(block)
+    return out
+
+
 class GetImage(TaskInProgress):
-    def __init__(self, sceneId, extent, resolution=None, headers={"content-type": "application/json"}):
+    backoff = PollingBackoff(initial=2.0, maximum=15.0)
+
+    def __init__(self, sceneId, extent, resolution=None, headers={"content-type": "application/json"},
+                 streaming=False, mmap_dir=None, chunk_size=1024 * 1024, cache=None, client=None,
+                 stretch=(2.0, 98.0)):
         '''
         Args:
             sceneId (string):
             extent (object):
             resolution (float):
+            streaming (bool): spool *.ski file to temporary file in chunks and decode bands lazily
+            mmap_dir (string): directory for temporary *.ski file and memory-mapped bands
+            chunk_size (int): size of chunk in bytes for streaming download
+            cache (DiskCache): cache of *.ski files, job is not initiated on cache hit
+            client (SpaceKnowClient): shared HTTP client, headers are not used if it is set
+            stretch (tuple of float): percentiles of display stretch of imageRGB, see SKImage
         '''
         self.sceneId = sceneId
         self.extent = extent
         self.resolution = resolution
+        self.streaming = streaming
+        self.mmap_dir = mmap_dir
+        self.chunk_size = chunk_size
+        self.stretch = stretch
         self.headers = headers
+        self.client = client
         self.pipelineId = None
         self.status = None
+        self.cache = cache
+        self.cache_key = image_key(sceneId, extent, resolution)
+        self.cached_meta = None
+
+    def initiate(self, use_cache=True):
+        if self.cache is not None and use_cache:
+            self.cached_meta = self.cache.get_json(image_meta_key(self.cache_key))
+            if self.cached_meta is not None:
+                self.status = "RESOLVED"
+                return
 
-    def initiate(self):
         payload = {
             "sceneId": self.sceneId,
             "extent": self.extent
@@ -157,10 +477,7 @@ class GetImage(TaskInProgress):
         if self.resolution is not None:
             payload.setdefault("resolution", self.resolution)
 
-        response = requests.post(
-            URL + "/imagery/get-image/initiate",
-            headers=self.headers,
-            data=json.dumps(payload))
+        response = self.post(URL + "/imagery/get-image/initiate", payload)
         if response.status_code == 200:
             response_json = response.json()
             self.pipelineId = response_json["pipelineId"]
@@ -171,26 +488,242 @@ class GetImage(TaskInProgress):
             self.status = "FAILED"
 
     def retrieve(self):
+        if self.cached_meta is not None:
+            ski_file = self.cache.open(self.cache_key)
+            if ski_file is not None:
+                self.meta = self.cached_meta["meta"]
+                self.extent = self.cached_meta["extent"]
+                self.skimage = SKImage(ski_file, lazy=self.streaming, mmap_dir=self.mmap_dir, stretch=self.stretch)
+                return
+            # *.ski file was evicted
+            self.cached_meta = None
+            self.initiate(use_cache=False)
+            self.wait_till_job_is_done()
+
         payload = {
             "pipelineId": self.pipelineId
         }
-        response = requests.post(
-            URL + "/imagery/get-image/retrieve",
-            headers=self.headers,
-            data=json.dumps(payload))
+        response = self.post(URL + "/imagery/get-image/retrieve", payload)
         if response.status_code == 200:
             response_json = response.json()
             self.meta = response_json["meta"]
             self.extent = response_json["extent"]
             url = response_json["url"]
-            urlstream = urlopen(url)
-            tempfile = BytesIO()
-            tempfile.write(urlstream.read())
-            tempfile.seek(0)
-            self.skimage = SKImage(tempfile)
+            with metrics.timer("image_download_seconds"):
+                urlstream = self.open_url(url)
+                if self.cache is not None:
+                    self.cache.put_file(self.cache_key, urlstream, self.chunk_size)
+                    self.cache.put_json(image_meta_key(self.cache_key), {"meta": self.meta, "extent": self.extent})
+                    ski_file = open(self.cache.path(self.cache_key), "rb")
+                elif self.streaming:
+                    ski_file = tempfile.TemporaryFile(dir=self.mmap_dir)
+                    shutil.copyfileobj(urlstream, ski_file, self.chunk_size)
+                else:
+                    ski_file = BytesIO()
+                    ski_file.write(urlstream.read())
+            metrics.inc("image_download_bytes_total", ski_file.seek(0, os.SEEK_END))
+            ski_file.seek(0)
+            self.skimage = SKImage(ski_file, lazy=self.streaming, mmap_dir=self.mmap_dir, stretch=self.stretch)
         else:
             print(response.status_code)
             print(response.json())
 
+    def open_url(self, url):
+        '''
+        Returns: file-like object with content of url
+        '''
+        if self.client is None:
+            return urlopen(url)
+        response = self.client.get(url, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response.raw
+
     def save_ski(self, url):
         pass
+
+    def close(self):
+        '''
+        Release decoded image and its temporary files
+        '''
+        if hasattr(self, "skimage"):
+            self.skimage.close()
+            del self.skimage
+
+
+class Mosaic:
+    def __init__(self, imageRGB):
+        '''
+        Image composed from tiles, it has imageRGB as SKImage
+        '''
+        self.imageRGB = imageRGB
+
+    def close(self):
+        self.imageRGB = None
+
+
+class TiledGetImage:
+    def __init__(self, metadata, extent, tile_size=2048, workers=4, mosaic_dir=None, resolution=None,
+                 headers={"content-type": "application/json"}, cache=None, client=None):
+        '''
+        GetImage of large extent split to tiles on pixel grid of the scene. Tiles are requested in parallel
+        and each decoded tile is written to its place in memory-mapped mosaic, so peak memory is given by tile size.
+        It can be used instead of GetImage, it has initiate, wait_till_job_is_done, retrieve, status, meta and skimage.
+        Args:
+            metadata (Metadata): scene, its band gives pixel grid (crsOriginX/Y, pixelSizeX/Y)
+            extent (object): area of interest
+            tile_size (int): width and height of tile in pixels
+            workers (int): number of tiles downloaded and decoded at once
+            mosaic_dir (string): directory of memory-mapped mosaic, temporary directory removed by close if None
+            resolution (float):
+            headers (dict): headers with authorization
+            cache (DiskCache): cache of *.ski files
+            client (SpaceKnowClient): shared HTTP client
+        '''
+        self.metadata = metadata
+        self.sceneId = metadata.sceneId
+        self.extent = extent
+        self.tile_size = tile_size
+        self.workers = workers
+        self.mosaic_dir = mosaic_dir
+        self.temp_dir = None
+        self.status = None
+        bands = {band.names[0]: band for band in metadata.bands}
+        self.band = bands.get("red", metadata.bands[0])
+        self.window = self.pixel_window()
+        self.tiles = []
+        for tile_window in self.tile_windows():
+            tile_extent = self.window_to_extent(tile_window)
+            # the same linear scaling of every tile, percentiles of tiles would differ at their seams
+            getimage = GetImage(self.sceneId, tile_extent, resolution=resolution, headers=headers, streaming=True,
+                                cache=cache, client=client, stretch=None)
+            self.tiles.append(getimage)
+
+    def __repr__(self):
+        return f"TiledGetImage sceneId={self.sceneId} window={self.window} tiles={len(self.tiles)}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Release mosaic and remove its temporary directory
+        '''
+        if hasattr(self, "skimage"):
+            self.skimage.close()
+            del self.skimage
+        if self.temp_dir is not None:
+            # memory map stays valid till it is released, even if its file is removed
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    def pixel_window(self):
+        '''
+        Returns: col0, row0, col1, row1 of extent in pixel grid of the scene
+        '''
+        minx, miny, maxx, maxy = geometry_bounds(self.extent)
+        corners = np.array([[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy]])
+        corners = EPSGTransformator(self.metadata.crsEpsg).transform_array(corners)
+        pixels = to_pixels(corners, (self.band.crsOriginX, self.band.crsOriginY),
+                           (self.band.pixelSizeX, self.band.pixelSizeY))
+        col0, row0 = np.floor(pixels.min(axis=0)).astype(int).tolist()
+        col1, row1 = np.ceil(pixels.max(axis=0)).astype(int).tolist()
+        return col0, row0, col1, row1
+
+    def tile_windows(self):
+        col0, row0, col1, row1 = self.window
+        t = self.tile_size
+        for row in range(row0 // t * t, row1, t):
+            for col in range(col0 // t * t, col1, t):
+                yield max(col, col0), max(row, row0), min(col + t, col1), min(row + t, row1)
+
+    def window_to_extent(self, window):
+        col0, row0, col1, row1 = window
+        pixels = np.array([[col0, row0], [col1, row0], [col1, row1], [col0, row1], [col0, row0]], dtype=np.float64)
+        coordinates = pixels * (self.band.pixelSizeX, self.band.pixelSizeY) + (self.band.crsOriginX, self.band.crsOriginY)
+        ring = EPSGTransformator(self.metadata.crsEpsg).inverse_transform_array(coordinates).tolist()
+        return geojson.GeometryCollection([geojson.Polygon([ring])])
+
+    def initiate(self):
+        for getimage in self.tiles:
+            getimage.initiate()
+        self.update_status()
+
+    def update_status(self):
+        statuses = [getimage.status for getimage in self.tiles]
+        if "FAILED" in statuses:
+            self.status = "FAILED"
+        elif all(status == "RESOLVED" for status in statuses):
+            self.status = "RESOLVED"
+        else:
+            self.status = "PROCESSING"
+        return self.status
+
+    def wait_till_job_is_done(self, backoff=None, poller=None):
+        for getimage in self.tiles:
+            getimage.wait_till_job_is_done(backoff=backoff, poller=poller)
+        self.update_status()
+
+    def retrieve(self):
+        col0, row0, col1, row1 = self.window
+        mosaic_dir = self.mosaic_dir
+        if mosaic_dir is None:
+            self.temp_dir = mosaic_dir = tempfile.mkdtemp(prefix="mosaic")
+        imageRGB = np.lib.format.open_memmap(os.path.join(mosaic_dir, self.sceneId + "_mosaic.npy"), mode="w+",
+                                             dtype=np.uint8, shape=(row1 - row0, col1 - col0, 3))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            metas = list(executor.map(lambda getimage: self.retrieve_tile(getimage, imageRGB), self.tiles))
+        imageRGB.flush()
+        failed = sum(meta is None for meta in metas)
+        if failed:
+            # mosaic with holes is not a result
+            print(f"{failed} of {len(self.tiles)} tiles of scene {self.sceneId} were not retrieved")
+            self.status = "FAILED"
+            del imageRGB
+            self.close()
+            return
+
+        # georeferencing of mosaic is the one of the first tile moved to origin of the window
+        bands = [dict(band) for band in metas[0]["bands"]] if metas and metas[0] else [{}]
+        for band in bands:
+            band.update({
+                "crsOriginX": self.band.crsOriginX + col0 * self.band.pixelSizeX,
+                "crsOriginY": self.band.crsOriginY + row0 * self.band.pixelSizeY,
+                "pixelSizeX": self.band.pixelSizeX,
+                "pixelSizeY": self.band.pixelSizeY,
+            })
+        self.meta = {"bands": bands}
+        self.skimage = Mosaic(imageRGB)
+
+    def retrieve_tile(self, getimage, imageRGB):
+        getimage.retrieve()
+        if not hasattr(getimage, "skimage"):
+            return None
+        band = getimage.meta["bands"][0]
+        tile = getimage.skimage.imageRGB
+        # place of tile in mosaic, given by its origin
+        col = int(round((band["crsOriginX"] - self.band.crsOriginX) / self.band.pixelSizeX)) - self.window[0]
+        row = int(round((band["crsOriginY"] - self.band.crsOriginY) / self.band.pixelSizeY)) - self.window[1]
+        height, width = imageRGB.shape[:2]
+        r0, c0 = max(row, 0), max(col, 0)
+        r1, c1 = min(row + tile.shape[0], height), min(col + tile.shape[1], width)
+        if r1 > r0 and c1 > c0:
+            imageRGB[r0:r1, c0:c1] = tile[r0 - row:r1 - row, c0 - col:c1 - col]
+        getimage.skimage.close()
+        del getimage.skimage
+        return getimage.meta
+
+if __name__ == '__main__':
+    # compare vectorized and reference skb decoders for every data type
+    rng = np.random.default_rng(0)
+    for data_type in SKImage.data_type_dict.values():
+        info = np.iinfo(data_type)
+        image = rng.integers(info.min, info.max, size=(37, 23), dtype=data_type, endpoint=True)
+        skb = SKImage.encode_skband(image)
+        fast = SKImage.parse_skband_file(BytesIO(skb))
+        reference = SKImage.parse_skband_file_reference(BytesIO(skb))
+        assert np.array_equal(fast, image) and np.array_equal(reference, image), data_type
+        print(f"{np.dtype(data_type).name}: OK")
@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+import traceback
+from collections import deque, OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, UnixStreamServer
+from authorization import SpaceKnowAuth
+from ragnar import SearchScene, SatelliteImagery
+from kraken import MAP_TYPES
+from cache import DiskCache
+from journal import PipelineJournal
+from planner import ScenePlanner
+from http_client import SpaceKnowClient
+from metrics import metrics
+from clipping import MODES
+from spaceknow_tools import TileFetcher
+from pipeline import run_job, run_scenes
+
+
+class JobQueue:
+    def __init__(self, queue_file):
+        '''
+        Persistent queue of analysis jobs. Submissions and status changes are appended to JSONL file
+        (like PipelineJournal), so jobs which were queued or running when the service stopped are queued
+        again after restart. Statuses of jobs are the same as of pipelines: NEW, PROCESSING, RESOLVED, FAILED.
+        Jobs of different clients are taken round robin, so a client submitting many
+        jobs does not delay jobs of the others.
+        Args:
+            queue_file (string): path to file of queue, it is created if it does not exist
+        '''
+        self.queue_file = queue_file
+        self.condition = threading.Condition()
+        self.jobs = OrderedDict()
+        # client -> deque of ids of waiting jobs, order of keys is the round robin
+        self.waiting = OrderedDict()
+        self.closed = False
+        if os.path.isfile(queue_file):
+            self.load()
+        self.file = open(queue_file, "a")
+
+    def __repr__(self):
+        return f"JobQueue {self.queue_file} jobs={len(self.jobs)}, waiting={sum(map(len, self.waiting.values()))}"
+
+    def load(self):
+        with open(self.queue_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of interrupted run may be incomplete
+                    continue
+                if entry.get("type") == "job":
+                    self.jobs[entry["id"]] = {key: entry[key] for key in ("id", "client", "request", "submitted")}
+                    self.jobs[entry["id"]]["status"] = "NEW"
+                elif entry.get("type") == "status" and entry["id"] in self.jobs:
+                    self.jobs[entry["id"]].update({key: value for key, value in entry.items()
+                                                   if key not in ["type", "id", "time"]})
+        for job in self.jobs.values():
+            if job["status"] in ["NEW", "PROCESSING"]:
+                # interrupted job is run again, its pipelines are resumed if the service has journal
+                job["status"] = "NEW"
+                self.waiting.setdefault(job["client"], deque()).append(job["id"])
+
+    def append(self, entry):
+        entry["time"] = time.time()
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def submit(self, request, client="default"):
+        '''
+        Args:
+            request (dict): request of analysis, see AnalysisService.run_analysis
+            client (string): name of client, jobs of clients are scheduled fairly
+        Returns: dict with job
+        '''
+        job = {"id": uuid.uuid4().hex[:16], "client": client, "request": request, "submitted": time.time()}
+        with self.condition:
+            self.append(dict(job, type="job"))
+            job["status"] = "NEW"
+            self.jobs[job["id"]] = job
+            self.waiting.setdefault(client, deque()).append(job["id"])
+            self.condition.notify()
+        return job
+
+    def get(self, timeout=None):
+        '''
+        Take the first waiting job of the next client, it blocks till there is any
+        Returns: dict with job, None if queue is closed or timeout expired
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.waiting or self.closed, timeout):
+                return None
+            if self.closed:
+                return None
+            client, ids = next(iter(self.waiting.items()))
+            job_id = ids.popleft()
+            # the client goes to the end of the round
+            del self.waiting[client]
+            if ids:
+                self.waiting[client] = ids
+            self.update(job_id, status="PROCESSING", started=time.time())
+            return self.jobs[job_id]
+
+    def update(self, job_id, **fields):
+        with self.condition:
+            self.jobs[job_id].update(fields)
+            self.append(dict(fields, type="status", id=job_id))
+
+    def job(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def list(self, client=None):
+        '''
+        Returns: list of jobs without their requests
+        '''
+        with self.condition:
+            return [{key: value for key, value in job.items() if key != "request"}
+                    for job in self.jobs.values() if client is None or job["client"] == client]
+
+    def stop(self):
+        '''
+        Stop handing out jobs, get returns None
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def close(self):
+        self.stop()
+        with self.condition:
+            self.file.close()
+
+
+class AnalysisService:
+    def __init__(self, queue, client, output_dir, satellite_imagery=None, workers=2, cache=None, tile_fetcher=None,
+                 journal=None, max_concurrency=8, max_polls_per_second=5.0):
+        '''
+        Long running service which runs analyses of extents from JobQueue by pool of worker threads.
+        Workers share authorized HTTP client, tile fetcher and cache and keep their transformers
+        (see get_transformation_function), so a job does not pay startup of a new process.
+        Args:
+            queue (JobQueue): queue of jobs
+            client (SpaceKnowClient): shared HTTP client with authorization
+            output_dir (string): images of each job are saved to its subdirectory
+            satellite_imagery (SatelliteImagery): imagery which is searched
+            workers (int): number of jobs run at once
+            cache (DiskCache): cache of search results, detections and images
+            tile_fetcher (TileFetcher): downloader of detection tiles shared by all jobs
+            journal (PipelineJournal): journal of pipelines, pipelines of interrupted jobs are resumed
+            max_concurrency (int): maximal number of Kraken and GetImage jobs in flight of one job
+            max_polls_per_second (float): maximal rate of job status requests of one job
+        '''
+        self.queue = queue
+        self.client = client
+        self.output_dir = output_dir
+        self.satellite_imagery = satellite_imagery or SatelliteImagery("gbdx", "idaho-pansharpened")
+        self.cache = cache
+        self.tile_fetcher = tile_fetcher if tile_fetcher is not None else TileFetcher(session=client, cache=cache)
+        self.journal = journal
+        self.max_concurrency = max_concurrency
+        self.max_polls_per_second = max_polls_per_second
+        self.threads = [threading.Thread(target=self._run_worker, name=f"AnalysisWorker-{i}", daemon=True)
+                        for i in range(workers)]
+
+    def __repr__(self):
+        return f"AnalysisService workers={len(self.threads)} {self.queue}"
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop taking new jobs and wait till running jobs are done
+        '''
+        self.queue.stop()
+        for thread in self.threads:
+            thread.join()
+        self.queue.close()
+
+    @staticmethod
+    def validate(request):
+        '''
+        Raises: ValueError if request can not be run
+        '''
+        if not isinstance(request, dict) or "extent" not in request:
+            raise ValueError("request has to be JSON object with extent")
+        unknown = [map_type for map_type in request.get("mapTypes", ["cars"]) if map_type not in MAP_TYPES]
+        if unknown:
+            raise ValueError(f"unknown map types {unknown}")
+        if request.get("clip", "centroid") not in MODES + [None]:
+            raise ValueError(f"unknown clip {request['clip']}")
+        ScenePlanner(**request.get("planner", {}))
+
+    def run_analysis(self, job):
+        '''
+        Search scenes of extent and run Kraken and GetImage of selected scenes, the same as main.py
+        Args:
+            job (dict): job from JobQueue, its request has keys extent (GeoJSON geometry), mapTypes,
+                startDatetime, endDatetime, clip (see MODES, null keeps all) and planner (arguments of ScenePlanner)
+        Returns: dict with result of job
+        '''
+        request = job["request"]
+        extent = request["extent"]
+        search = SearchScene(self.satellite_imagery, extent, startDatetime=request.get("startDatetime"),
+                             endDatetime=request.get("endDatetime"), cache=self.cache, client=self.client)
+        run_job(search, journal=self.journal)
+        if search.status != "RESOLVED":
+            raise RuntimeError(f"SearchScene is {search.status}")
+        scenes, rejected = ScenePlanner(**request.get("planner", {})).plan(search.results, extent)
+        output_dir = os.path.join(self.output_dir, job["id"])
+        os.makedirs(output_dir, exist_ok=True)
+        img_files = run_scenes(scenes, extent, {}, max_concurrency=self.max_concurrency,
+                               max_polls_per_second=self.max_polls_per_second, tile_fetcher=self.tile_fetcher,
+                               cache=self.cache, client=self.client, journal=self.journal,
+                               map_types=request.get("mapTypes", ["cars"]), clip=request.get("clip", "centroid"),
+                               output_dir=output_dir)
+        return {
+            "scenes": [metadata.sceneId for metadata in scenes],
+            "rejected": {metadata.sceneId: reason for metadata, reason in rejected},
+            "images": img_files,
+        }
+
+    def _run_worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            metrics.observe("service_queue_seconds", job["started"] - job["submitted"])
+            try:
+                with metrics.timer("service_job_seconds"):
+                    result = self.run_analysis(job)
+                self.queue.update(job["id"], status="RESOLVED", finished=time.time(), result=result)
+            except Exception as e:
+                traceback.print_exc()
+                self.queue.update(job["id"], status="FAILED", finished=time.time(), error=f"{type(e).__name__}: {e}")
+            metrics.inc("service_jobs_total", status=self.queue.job(job["id"])["status"])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        queue = self.service.queue
+        if parts == ["jobs"]:
+            self.send(200, {"jobs": queue.list()})
+        elif parts[0] == "jobs" and len(parts) == 2:
+            job = queue.job(parts[1])
+            if job is None:
+                self.send(404, {"error": f"unknown job {parts[1]}"})
+            else:
+                self.send(200, {key: value for key, value in job.items() if key != "request"})
+        elif parts == ["metrics"]:
+            self.send(200, metrics.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self.send(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.strip("/") != "jobs":
+            self.send(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(body)
+            self.service.validate(request)
+        except (ValueError, TypeError) as e:
+            self.send(400, {"error": str(e)})
+            return
+        job = self.service.queue.submit(request, client=request.pop("client", None) or "default")
+        self.send(202, {"id": job["id"], "status": job["status"]})
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host="127.0.0.1", port=8090, socket_path=None):
+    '''
+    Serve API of service over HTTP on host and port, or on Unix socket if socket_path is set:
+        POST /jobs      submit job, body is request of AnalysisService.run_analysis with optional client
+        GET /jobs       list jobs
+        GET /jobs/<id>  status and result of job
+        GET /metrics    metrics in Prometheus text format
+    Returns: server, it is not started
+    '''
+    handler = type("Handler", (_Handler,), {"service": service})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-u", "--username", help="username of Spaceknow account", required=False)
+    ap.add_argument("-p", "--password", help="password of Spaceknow account", required=False)
+    ap.add_argument("-t", "--token-file", help="file where to save/load token for future usage", required=False, default=None)
+    ap.add_argument("--host", help="host of HTTP API", default="127.0.0.1")
+    ap.add_argument("--port", help="port of HTTP API", type=int, default=8090)
+    ap.add_argument("--socket", help="serve API on this Unix socket instead of host and port", default=None)
+    ap.add_argument("--queue", help="file of persistent job queue", default="jobs.jsonl")
+    ap.add_argument("--output-dir", help="directory of output images, each job has its subdirectory", default="output")
+    ap.add_argument("--workers", help="number of jobs run at once", type=int, default=2)
+    ap.add_argument("--max-concurrency", help="maximal number of Kraken and GetImage jobs in flight of one job", type=int, default=8)
+    ap.add_argument("--max-polls-per-second", help="maximal rate of job status requests of one job", type=float, default=5.0)
+    ap.add_argument("--tile-workers", help="number of detection tiles downloaded at once", type=int, default=16)
+    ap.add_argument("--cache-dir", help="directory of cache of search results, detections and images", default=None)
+    ap.add_argument("--cache-size-mb", help="maximal size of cache in MB", type=int, default=10 * 1024)
+    ap.add_argument("--journal", help="journal file of pipelines, pipelines of interrupted jobs are resumed", default=None)
+    args = vars(ap.parse_args())
+
+    client = SpaceKnowClient()
+    auth = SpaceKnowAuth(username=args["username"], password=args["password"], token_file=args["token_file"],
+                         client=client)
+    client.auth = auth
+
+    cache = None
+    if args["cache_dir"] is not None:
+        cache = DiskCache(args["cache_dir"], max_bytes=args["cache_size_mb"] * 1024 ** 2)
+    journal = None
+    if args["journal"] is not None:
+        journal = PipelineJournal(args["journal"])
+
+    service = AnalysisService(JobQueue(args["queue"]), client, args["output_dir"], workers=args["workers"],
+                              cache=cache, tile_fetcher=TileFetcher(workers=args["tile_workers"], session=client, cache=cache),
+                              journal=journal, max_concurrency=args["max_concurrency"],
+                              max_polls_per_second=args["max_polls_per_second"])
+    server = serve(service, args["host"], args["port"], args["socket"])
+    service.start()
+    print(service, "listening on", args["socket"] or f"{args['host']}:{args['port']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        auth.close()
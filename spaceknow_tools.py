@@ -1,8 +1,16 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import geojson
+import requests
 import numpy as np
 import cv2
 from pyreproj import Reprojector
 from urllib.request import urlopen
+from cache import tile_key
+from metrics import metrics
+
+KRAKEN_URL = "https://spaceknow-kraken.appspot.com"
 
 # preview-multispectral
 # preview-swir
@@ -31,6 +39,10 @@ class SatelliteImagery:
         return f"{self.provider}:{self.dataset}"
 
 class Band:
+    __slots__ = ("names", "bitDepth", "gsd", "pixelSizeX", "pixelSizeY", "crsOriginX", "crsOriginY",
+                 "approximateResolutionX", "approximateResolutionY",
+                 "radianceMult", "radianceAdd", "reflectanceMult", "reflectanceAdd")
+
     def __init__(self, names, bitDepth, gsd, pixelSizeX, pixelSizeY, crsOriginX, crsOriginY,
                  approximateResolutionX, approximateResolutionY,
                  radianceMult=1, radianceAdd=0, reflectanceMult=1, reflectanceAdd=0):
@@ -74,6 +86,9 @@ class Band:
                    **optional_arguments)
 
 class Metadata:
+    __slots__ = ("sceneId", "satellite_imagery", "satellite", "datetime", "crsEpsg", "footprint",
+                 "offNadir", "sunElevation", "sunAzimuth", "satelliteAzimuth", "cloudCover", "anomalousRatio", "bands")
+
     def __init__(self, sceneId, satellite_imagery, satellite, datetime, crsEpsg, footprint,
                  offNadir=None, sunElevation=None, sunAzimuth=None, satelliteAzimuth=None,
                  cloudCover=None, anomalousRatio=None, bands=[]):
@@ -135,23 +150,293 @@ class Metadata:
                    **optional_arguments)
 
 class DetectionTile:
-    def __init__(self, mapId, tile, geometryId="-"):
+    def __init__(self, mapId, tile, geometryId="-", session=None, cache=None):
+        '''
+        Args:
+            mapId (string): mapId from Kraken retrieve
+            tile (list of int): zoom, x, y
+            geometryId (string):
+            session (requests.Session): session to download tile with, urlopen is used if None
+            cache (DiskCache): cache of downloaded tiles
+        '''
         self.mapId = mapId
         self.geometry_id = geometryId
         self.zoom, self.x, self.y = tile
         self.features = []
-        f = urlopen(self.url())
-        g = geojson.loads(f.read())
+        key = tile_key(mapId, geometryId, self.zoom, self.x, self.y)
+        data = cache.get(key) if cache is not None else None
+        if data is None:
+            data = self.download(session)
+            if cache is not None:
+                cache.put(key, data)
+        g = geojson.loads(data)
         self.features = g.features
 
+    def download(self, session=None):
+        with metrics.timer("tile_download_seconds"):
+            if session is None:
+                data = urlopen(self.url()).read()
+            else:
+                response = session.get(self.url(), timeout=60)
+                response.raise_for_status()
+                data = response.content
+        metrics.inc("tile_download_bytes_total", len(data))
+        return data
+
     def url(self):
-        return f"https://spaceknow-kraken.appspot.com/kraken/grid/{self.mapId}/{self.geometry_id}/{self.zoom}/{self.x}/{self.y}/detections.geojson"
+        return f"{KRAKEN_URL}/kraken/grid/{self.mapId}/{self.geometry_id}/{self.zoom}/{self.x}/{self.y}/detections.geojson"
+
+class TileFetcher:
+    def __init__(self, workers=16, retries=3, retry_delay=1.0, session=None, cache=None):
+        '''
+        Download detection tiles concurrently over shared keep-alive connections
+        Args:
+            workers (int): number of tiles downloaded at once
+            retries (int): number of retries of one tile
+            retry_delay (float): delay in seconds before the first retry, it doubles with every next retry
+            session (requests.Session or SpaceKnowClient): session with connection pool, a new one is created if None
+            cache (DiskCache): cache of downloaded tiles
+        '''
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+            session.mount("https://", adapter)
+        self.session = session
+        self.cache = cache
+
+    def fetch_tile(self, mapId, tile, geometryId="-"):
+        for attempt in range(self.retries + 1):
+            try:
+                return DetectionTile(mapId, tile, geometryId, session=self.session, cache=self.cache)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                response = getattr(e, "response", None)
+                if response is not None and response.status_code < 500 and response.status_code != 429:
+                    raise
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def fetch(self, mapId, tiles, geometryId="-"):
+        '''
+        Generator of detection tiles in order as they are downloaded
+        Args:
+            mapId (string): mapId from Kraken retrieve
+            tiles (list of list of int): list of [zoom, x, y]
+        Returns: generator of DetectionTile
+        '''
+        # downloads belong to scene of the calling thread in trace
+        scene = metrics.current_scene()
+
+        def fetch_tile(tile):
+            with metrics.scene(scene):
+                return self.fetch_tile(mapId, tile, geometryId)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(fetch_tile, tile) for tile in tiles]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+def geometry_points(geometry):
+    '''
+    Generator of all points of GeoJSON object (Geometry, GeometryCollection, Feature or FeatureCollection)
+    '''
+    if isinstance(geometry, dict):
+        if "coordinates" in geometry:
+            yield from geometry_points(geometry["coordinates"])
+        for key in ("geometries", "features"):
+            for item in geometry.get(key, []):
+                yield from geometry_points(item)
+        if geometry.get("geometry") is not None:
+            yield from geometry_points(geometry["geometry"])
+    elif isinstance(geometry, (list, tuple)):
+        if len(geometry) >= 2 and all(isinstance(v, (int, float)) for v in geometry):
+            yield geometry[:2]
+        else:
+            for item in geometry:
+                yield from geometry_points(item)
+
+def geometry_bounds(geometry):
+    '''
+    Bounding box of GeoJSON object
+    Returns: tuple (minx, miny, maxx, maxy) or None if object has no points
+    '''
+    points = np.array(list(geometry_points(geometry)), dtype=np.float64)
+    if len(points) == 0:
+        return None
+    return tuple(points.min(axis=0).tolist() + points.max(axis=0).tolist())
+
+def bounds_to_geometry(bounds):
+    '''
+    GeometryCollection with one rectangular Polygon, in the same form as files in Extent/
+    '''
+    minx, miny, maxx, maxy = bounds
+    ring = [[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]
+    return geojson.GeometryCollection([geojson.Polygon([ring])])
+
+def geometry_polygons(geometry):
+    '''
+    Generator of all polygons of GeoJSON object, each polygon is list of rings (exterior ring and holes)
+    '''
+    if geometry is None:
+        return
+    if geometry.get("type") == "Polygon":
+        yield geometry["coordinates"]
+    elif geometry.get("type") == "MultiPolygon":
+        yield from geometry["coordinates"]
+    for item in geometry.get("geometries", []) + geometry.get("features", []):
+        yield from geometry_polygons(item)
+    if geometry.get("geometry") is not None:
+        yield from geometry_polygons(geometry["geometry"])
+
+def flatten_features(features):
+    '''
+    Collect coordinates of all rings of all Polygon/MultiPolygon features to one array
+    Args:
+        features (list of geojson.Feature):
+    Returns: tuple (coordinates, ring_offsets, feature_offsets), where coordinates is np.array with shape (N, 2),
+        points of i-th ring are coordinates[ring_offsets[i]:ring_offsets[i+1]]
+        and rings of j-th feature are rings feature_offsets[j] .. feature_offsets[j+1]-1
+    '''
+    rings = []
+    feature_offsets = [0]
+    for feature in features:
+        geometry = feature["geometry"]
+        if geometry is not None:
+            if geometry["type"] == "Polygon":
+                rings.extend(geometry["coordinates"])
+            elif geometry["type"] == "MultiPolygon":
+                for polygon in geometry["coordinates"]:
+                    rings.extend(polygon)
+        feature_offsets.append(len(rings))
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(ring) for ring in rings], out=ring_offsets[1:])
+    coordinates = np.empty((ring_offsets[-1], 2), dtype=np.float64)
+    for ring, start, end in zip(rings, ring_offsets[:-1], ring_offsets[1:]):
+        coordinates[start:end] = [point[:2] for point in ring]
+    return coordinates, ring_offsets, np.array(feature_offsets, dtype=np.int64)
+
+def feature_bounds(features):
+    '''
+    Bounding boxes of features
+    Returns: np.array with shape (len(features), 4) of minx, miny, maxx, maxy, rows of features without coordinates are nan
+    '''
+    coordinates, ring_offsets, feature_offsets = flatten_features(features)
+    point_offsets = ring_offsets[feature_offsets]
+    bounds = np.full((len(features), 4), np.nan)
+    nonempty = np.diff(point_offsets) > 0
+    if nonempty.any():
+        starts = point_offsets[:-1][nonempty]
+        bounds[nonempty, :2] = np.minimum.reduceat(coordinates, starts, axis=0)
+        bounds[nonempty, 2:] = np.maximum.reduceat(coordinates, starts, axis=0)
+    return bounds
+
+class DetectionDeduplicator:
+    def __init__(self, iou_threshold=0.5, max_centroid_distance=None, cell_size=1e-4):
+        '''
+        Remove duplicate detections (e.g. a car on the edge of two Kraken tiles) as features stream in.
+        Bounding boxes are indexed in a grid hash, so each feature is compared only with its neighbours.
+        Args:
+            iou_threshold (float): feature is duplicate if IoU of its bounding box with an earlier one is at least this
+            max_centroid_distance (float): feature is duplicate if its centroid is closer to an earlier one, in units
+                of coordinates; if set, it is used instead of iou_threshold
+            cell_size (float): size of grid cell in units of coordinates, about size of one detection
+        '''
+        self.iou_threshold = iou_threshold
+        self.max_centroid_distance = max_centroid_distance
+        self.cell_size = cell_size
+        self.grid = {}
+        self.bounds = []
+        self.raw_count = 0
+        self.count = 0
+
+    def __repr__(self):
+        return f"DetectionDeduplicator raw={self.raw_count}, unique={self.count}"
+
+    def cells(self, box):
+        if self.max_centroid_distance is not None:
+            cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+            d = self.max_centroid_distance
+            box = (cx - d, cy - d, cx + d, cy + d)
+        x0, y0, x1, y1 = (int(np.floor(v / self.cell_size)) for v in box)
+        return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    def is_duplicate(self, box, other):
+        if self.max_centroid_distance is not None:
+            dx = (box[0] + box[2] - other[0] - other[2]) / 2
+            dy = (box[1] + box[3] - other[1] - other[3]) / 2
+            return dx * dx + dy * dy <= self.max_centroid_distance ** 2
+        w = min(box[2], other[2]) - max(box[0], other[0])
+        h = min(box[3], other[3]) - max(box[1], other[1])
+        if w < 0 or h < 0:
+            return False
+        intersection = w * h
+        union = (box[2] - box[0]) * (box[3] - box[1]) + (other[2] - other[0]) * (other[3] - other[1]) - intersection
+        if union <= 0:
+            # degenerate boxes (points or lines) are duplicates if they are the same
+            return tuple(box) == tuple(other)
+        return intersection / union >= self.iou_threshold
+
+    def add(self, features):
+        '''
+        Args:
+            features (list of geojson.Feature): next batch of features, e.g. from one tile
+        Returns: list of features which are not duplicates of any earlier feature
+        '''
+        unique = self.add_bounds(feature_bounds(features))
+        return [feature for feature, keep in zip(features, unique) if keep]
+
+    def add_bounds(self, bounds):
+        '''
+        Args:
+            bounds (np.array): shape (N, 4), bounding boxes of next batch of features, see feature_bounds
+                and DetectionStore.bounds
+        Returns: bool np.array with shape (N,), True for features which are not duplicates of any earlier feature
+        '''
+        unique = np.zeros(len(bounds), dtype=bool)
+        for i, box in enumerate(bounds.tolist()):
+            self.raw_count += 1
+            if np.isnan(box[0]):
+                unique[i] = True
+                continue
+            cells = self.cells(box)
+            candidates = {index for cell in cells for index in self.grid.get(cell, ())}
+            if any(self.is_duplicate(box, self.bounds[index]) for index in candidates):
+                continue
+            index = len(self.bounds)
+            self.bounds.append(box)
+            for cell in cells:
+                self.grid.setdefault(cell, []).append(index)
+            unique[i] = True
+        self.count += int(unique.sum())
+        return unique
+
+_transformers = threading.local()
+
+def get_transformation_function(crsEpsg, inverse=False):
+    '''
+    Transformation function from WGS84 to crsEpsg (or from crsEpsg to WGS84 if inverse),
+    it is created once per crsEpsg (and thread, transformers are not thread-safe)
+    '''
+    cache = _transformers.__dict__.setdefault("cache", {})
+    if (crsEpsg, inverse) not in cache:
+        if inverse:
+            cache[crsEpsg, inverse] = Reprojector().get_transformation_function(from_srs=crsEpsg)
+        else:
+            cache[crsEpsg, inverse] = Reprojector().get_transformation_function(to_srs=crsEpsg)
+    return cache[crsEpsg, inverse]
 
 class EPSGTransformator:
     def __init__(self, crsEpsg):
         self.crsEpsg = crsEpsg
-        rp = Reprojector()
-        self.transform_fce = rp.get_transformation_function(to_srs=crsEpsg)
+        self.transform_fce = get_transformation_function(crsEpsg)
+        self.inverse_transform_fce = get_transformation_function(crsEpsg, inverse=True)
 
     def transform(self, points):
         '''
@@ -161,7 +446,123 @@ class EPSGTransformator:
 
         Returns: list of Points in new coordinates
         '''
-        return [self.transform_fce(p[0], p[1]) for p in points]
+        points = self.transform_array(np.asarray(points, dtype=np.float64)[:, :2])
+        return [tuple(p) for p in points.tolist()]
+
+    def transform_array(self, coordinates):
+        '''
+        Transform coordinates from WGS84 to crsEpsg in one vectorized call
+        Args:
+            coordinates (np.array): array with shape (N, 2)
+        Returns: np.array with shape (N, 2)
+        '''
+        ret = np.empty((len(coordinates), 2), dtype=np.float64)
+        if len(coordinates) > 0:
+            ret[:, 0], ret[:, 1] = self.transform_fce(coordinates[:, 0], coordinates[:, 1])
+        return ret
+
+    def inverse_transform_array(self, coordinates):
+        '''
+        Transform coordinates from crsEpsg to WGS84 in one vectorized call
+        Args:
+            coordinates (np.array): array with shape (N, 2)
+        Returns: np.array with shape (N, 2)
+        '''
+        ret = np.empty((len(coordinates), 2), dtype=np.float64)
+        if len(coordinates) > 0:
+            ret[:, 0], ret[:, 1] = self.inverse_transform_fce(coordinates[:, 0], coordinates[:, 1])
+        return ret
+
+    def transform_features(self, features):
+        '''
+        Transform coordinates of all features at once
+        Args:
+            features (list of geojson.Feature): Polygon or MultiPolygon features
+        Returns: tuple (coordinates, ring_offsets, feature_offsets), see flatten_features
+        '''
+        coordinates, ring_offsets, feature_offsets = flatten_features(features)
+        return self.transform_array(coordinates), ring_offsets, feature_offsets
+
+def to_pixels(coordinates, crsOrigin, pixelSize, shift=0):
+    '''
+    Convert coordinates in crs of image to pixel coordinates
+    Args:
+        coordinates (np.array): array with shape (N, 2)
+        crsOrigin (list of crsOrigin): [crsOriginX, crsOriginY] from metadata
+        pixelSize(list of pixelSize): [pixelSizeX, pixelSizeY] from metadata
+        shift (int): number of fractional bits of pixel coordinates, see shift in cv2.polylines
+    Returns: np.array of float64 with shape (N, 2)
+    '''
+    pixels = np.subtract(coordinates, crsOrigin)
+    pixels /= pixelSize
+    if shift:
+        pixels *= 1 << shift
+    return pixels
+
+def visible_rings(pixels, ring_offsets, image_shape, shift=0):
+    '''
+    Cull rings which are empty, have non-finite coordinates or whose bounding box is outside the image
+    Returns: np.array of bool, True for rings to be drawn
+    '''
+    lengths = np.diff(ring_offsets)
+    visible = lengths > 0
+    if not visible.any():
+        return visible
+    starts = ring_offsets[:-1][visible]
+    finite = np.isfinite(pixels).all(axis=1)
+    mins = np.minimum.reduceat(pixels, starts, axis=0)
+    maxs = np.maximum.reduceat(pixels, starts, axis=0)
+    all_finite = np.logical_and.reduceat(finite, starts)
+    height, width = image_shape[:2]
+    scale = 1 << shift
+    inside = (maxs[:, 0] >= 0) & (maxs[:, 1] >= 0) & (mins[:, 0] < width * scale) & (mins[:, 1] < height * scale)
+    visible[visible] = inside & all_finite
+    return visible
+
+def draw_polygons(image, crsOrigin, pixelSize, coordinates, ring_offsets, color, classes=None, colors=None,
+                  fill=False, antialias=False, shift=0, thickness=1):
+    '''
+    Draw all rings to image by one cv2.polylines (or cv2.fillPoly) call per colour
+    Args:
+        image (np.array):
+        crsOrigin (list of crsOrigin): [crsOriginX, crsOriginY] from metadata
+        pixelSize(list of pixelSize): [pixelSizeX, pixelSizeY] from metadata
+        coordinates (np.array): coordinates of all rings with shape (N, 2), see EPSGTransformator.transform_features
+        ring_offsets (np.array): points of i-th ring are coordinates[ring_offsets[i]:ring_offsets[i+1]]
+        color (tuple of int): colour of rings without class
+        classes (np.array): optional class of each ring
+        colors (dict): colour of each class
+        fill (bool): fill polygons instead of drawing their outline
+        antialias (bool): draw anti-aliased lines
+        shift (int): number of fractional bits of pixel coordinates (sub-pixel precision)
+        thickness (int): thickness of lines
+    Returns: image
+    '''
+    ring_offsets = np.asarray(ring_offsets)
+    pixels = to_pixels(coordinates, crsOrigin, pixelSize, shift)
+    visible = visible_rings(pixels, ring_offsets, image.shape, shift)
+    line_type = cv2.LINE_AA if antialias else cv2.LINE_8
+    if shift:
+        pixels = np.round(pixels)
+    # clip far away points, cv2 works with int32
+    limit = 1 << 30
+    pixels = np.clip(np.nan_to_num(pixels), -limit, limit).astype(np.int32)
+    rings = np.split(pixels, ring_offsets[1:-1])
+
+    if classes is None:
+        groups = [(color, np.flatnonzero(visible))]
+    else:
+        classes = np.asarray(classes)
+        groups = [(colors.get(c, color), np.flatnonzero(visible & (classes == c))) for c in np.unique(classes[visible])]
+    for group_color, indexes in groups:
+        if len(indexes) == 0:
+            continue
+        polygons = [rings[i] for i in indexes]
+        if fill:
+            cv2.fillPoly(image, polygons, group_color, line_type, shift)
+        else:
+            cv2.polylines(image, polygons, True, group_color, thickness, line_type, shift)
+    return image
 
 def draw_extent(image, crsOrigin, pixelSize, polygons, color):
     '''
@@ -174,9 +575,8 @@ def draw_extent(image, crsOrigin, pixelSize, polygons, color):
         color (tuple of int): tuple of 3 numbers representing RGB - red green, blue
     Returns: image
     '''
-    npcrsOriginXY = np.array(crsOrigin)
-    nppixelSizeXY = np.array(pixelSize)
-    for polygon in polygons:
-        dif = np.array(polygon) - npcrsOriginXY
-        polygon_to_draw = np.divide(dif, nppixelSizeXY).astype(np.int)
-        cv2.polylines(image, [polygon_to_draw], True, color)
+    polygons = [np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons]
+    ring_offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    np.cumsum([len(polygon) for polygon in polygons], out=ring_offsets[1:])
+    coordinates = np.concatenate(polygons) if polygons else np.empty((0, 2))
+    return draw_polygons(image, crsOrigin, pixelSize, coordinates, ring_offsets, color)
@@ -1,45 +1,208 @@
 import time
 import json
+import heapq
+import random
+import itertools
+import threading
+from concurrent.futures import Future
 import requests
+from metrics import metrics
 
 URL = "https://spaceknow-tasking.appspot.com"
 
+
+class PollingBackoff:
+    def __init__(self, initial=1.0, factor=1.5, maximum=10.0, jitter=0.1):
+        '''
+        Delays between status polls, they start at initial and grow by factor up to maximum
+        Args:
+            initial (float): first delay in seconds
+            factor (float): multiplier of delay after each poll
+            maximum (float): cap of delay in seconds
+            jitter (float): relative random deviation of delay, e.g. 0.1 means +-10%
+        '''
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def __repr__(self):
+        return f"PollingBackoff {self.initial}s * {self.factor}^n up to {self.maximum}s"
+
+    def delay(self, attempt):
+        delay = min(self.maximum, self.initial * self.factor ** attempt)
+        delay *= random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+        return min(self.maximum, delay)
+
+
 class TaskInProgress:
-    def __init__(self, pipelineId, status=None, headers={"content-type": "application/json"}):
+    # hint how fast the job usually gets done, subclasses override it
+    backoff = PollingBackoff()
+
+    def __init__(self, pipelineId, status=None, headers={"content-type": "application/json"}, client=None):
         self.pipelineId = pipelineId
         self.status = status
         self.headers = headers
+        self.client = client
         if self.status is None:
             self.checkStatus()
 
-    def checkStatus(self):
-        if not hasattr(self, "pipelineId"):
-            raise TypeError("Instance of class TaskInProgress has no atrribute pipelineId")
+    @property
+    def status(self):
+        return getattr(self, "_status", None)
+
+    @status.setter
+    def status(self, status):
+        '''
+        Time spent in NEW (queue) and PROCESSING status is observed when status changes
+        '''
+        previous = getattr(self, "_status", None)
+        if status != previous:
+            now = time.perf_counter()
+            since = getattr(self, "_status_since", None)
+            if previous in ["NEW", "PROCESSING"] and since is not None:
+                job = type(self).__name__
+                metrics.observe("task_status_seconds", now - since, job=job, status=previous)
+                metrics.span(f"{job} {previous}", since, now, scene=getattr(self, "sceneId", None),
+                             job=job, status=previous)
+            self._status_since = now
+        self._status = status
+
+    def post(self, url, payload):
+        '''
+        POST payload as json by shared client if the job has one, otherwise by one-off request with self.headers
+        Returns: requests.Response
+        '''
+        client = getattr(self, "client", None)
+        if client is not None:
+            return client.post(url, data=json.dumps(payload))
         if hasattr(self, "headers"):
             headers = self.headers
         else:
             headers = {"content-type": "application/json"}
+        return requests.post(url, headers=headers, data=json.dumps(payload))
+
+    def checkStatus(self):
+        if not hasattr(self, "pipelineId"):
+            raise TypeError("Instance of class TaskInProgress has no atrribute pipelineId")
 
         request = {
             "pipelineId": self.pipelineId
         }
-        response = requests.post(
-            URL + "/tasking/get-status",
-            headers=headers,
-            data=json.dumps(request))
+        metrics.inc("task_polls_total", job=type(self).__name__)
+        response = self.post(URL + "/tasking/get-status", request)
         response_json = response.json()
         self.status = response_json["status"]
         return self.status
 
-    def wait_till_job_is_done(self):
+    def wait_till_job_is_done(self, backoff=None, poller=None):
+        '''
+        Block till job is FAILED or RESOLVED
+        Args:
+            backoff (PollingBackoff): delays between polls, default is backoff of the class
+            poller (StatusPoller): shared poller, if set the job is polled by it instead of own loop
+        '''
         if self.status in ["NEW", "PROCESSING"]:
-            while True:
+            if poller is not None:
+                poller.watch(self, backoff=backoff).result()
+                return
+            if backoff is None:
+                backoff = self.backoff
+            for attempt in itertools.count():
                 self.checkStatus()
                 if self.status in ["FAILED", "RESOLVED"]:
                     # not in ["NEW", "PROCESSING"]
                     break
-                time.sleep(10.0)
+                time.sleep(backoff.delay(attempt))
+
+
+class StatusPoller:
+    def __init__(self, max_requests_per_second=5.0):
+        '''
+        Poll status of many jobs from one thread. Requests are spread so that their rate
+        is never higher than max_requests_per_second, no matter how many jobs are watched.
+        Args:
+            max_requests_per_second (float): upper bound of rate of /tasking/get-status requests
+        '''
+        self.min_interval = 1.0 / max_requests_per_second
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (time of next poll, sequence number, task, backoff, attempt, future)
+        self.sequence = itertools.count()
+        self.thread = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def watch(self, task, callback=None, backoff=None):
+        '''
+        Start watching the task
+        Args:
+            task (TaskInProgress): initiated job
+            callback (function): called with the task when it is FAILED or RESOLVED
+            backoff (PollingBackoff): delays between polls, default is backoff of the task
+        Returns: Future, its result is the task
+        '''
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(task))
+        if task.status not in ["NEW", "PROCESSING"]:
+            future.set_result(task)
+            return future
+        if backoff is None:
+            backoff = task.backoff
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("StatusPoller is closed")
+            self._schedule(time.monotonic(), task, backoff, 0, future)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="StatusPoller", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def close(self):
+        '''
+        Stop polling when all watched tasks are done
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _schedule(self, when, task, backoff, attempt, future):
+        heapq.heappush(self.queue, (when, next(self.sequence), task, backoff, attempt, future))
+
+    def _run(self):
+        last_request = -self.min_interval
+        while True:
+            with self.condition:
+                if not self.queue:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    continue
+                wait = max(self.queue[0][0], last_request + self.min_interval) - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                _, _, task, backoff, attempt, future = heapq.heappop(self.queue)
 
+            last_request = time.monotonic()
+            try:
+                task.checkStatus()
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if task.status in ["FAILED", "RESOLVED"]:
+                future.set_result(task)
+            else:
+                with self.condition:
+                    self._schedule(time.monotonic() + backoff.delay(attempt), task, backoff, attempt + 1, future)
 
 if __name__ == '__main__':
     task = TaskInProgress("Y12G0nncqAMDPpW4ESaA")
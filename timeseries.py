@@ -0,0 +1,161 @@
+import os
+import re
+import csv
+import json
+import tempfile
+import threading
+from cache import hash_key
+from detections import DetectionStore
+
+
+class TimeSeriesStore:
+    def __init__(self, directory):
+        '''
+        Local store of processed scenes of tracked extents. Each extent has its own directory with state.json
+        (counts of scenes and their output images) and detections of each scene and map type in *.npz files.
+        The watermark of extent is passed to SearchScene as startDatetime, so only new scenes are searched.
+        Args:
+            directory (string): root directory of the store, it is created if it does not exist
+        '''
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.states = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"TimeSeriesStore {self.directory}"
+
+    def extent_dir(self, extent):
+        return os.path.join(self.directory, hash_key("extent", extent)[:16])
+
+    def state(self, extent, name=None):
+        '''
+        Returns: dict with name, scenes (sceneId -> result) and failed (sceneId -> datetime) of extent
+        '''
+        extent_dir = self.extent_dir(extent)
+        with self.lock:
+            if extent_dir not in self.states:
+                state_file = os.path.join(extent_dir, "state.json")
+                if os.path.isfile(state_file):
+                    self.states[extent_dir] = json.load(open(state_file))
+                else:
+                    self.states[extent_dir] = {"name": name, "extent": extent, "scenes": {}, "failed": {}}
+            return self.states[extent_dir]
+
+    def save_state(self, extent):
+        extent_dir = self.extent_dir(extent)
+        os.makedirs(extent_dir, exist_ok=True)
+        with self.lock:
+            data = json.dumps(self.states[extent_dir], indent=1)
+        fd, temp_path = tempfile.mkstemp(dir=extent_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(temp_path, os.path.join(extent_dir, "state.json"))
+
+    def watermark(self, extent, map_types=None):
+        '''
+        Datetime from which extent has to be searched again: acquisition of the earliest failed scene
+        or scene without some of map_types, otherwise of the latest processed scene. None if no scene was processed.
+        '''
+        state = self.state(extent)
+        failed = [dt for sceneId, dt in state["failed"].items() if sceneId not in state["scenes"]]
+        failed += [scene["datetime"] for scene in state["scenes"].values()
+                   if not all(map_type in scene["counts"] for map_type in map_types or ())]
+        if failed:
+            return min(failed)
+        return max((scene["datetime"] for scene in state["scenes"].values()), default=None)
+
+    def is_done(self, extent, metadata, map_types=None):
+        '''
+        Returns: True if scene was recorded with detections of all map_types (of any map type if None)
+        '''
+        scene = self.state(extent)["scenes"].get(metadata.sceneId)
+        return scene is not None and all(map_type in scene["counts"] for map_type in map_types or ())
+
+    def new_scenes(self, extent, scenes, map_types=None):
+        '''
+        Scenes which were not processed yet for all map_types, search from watermark returns
+        the last processed scene again
+        '''
+        return [metadata for metadata in scenes if not self.is_done(extent, metadata, map_types)]
+
+    def record(self, extent, metadata, detections, img_file, name=None):
+        '''
+        Record result of scene, map types recorded before for the scene are kept
+        Args:
+            extent (object): tracked extent
+            metadata (Metadata): processed scene
+            detections (dict): map type -> DetectionStore of the scene clipped to extent
+            img_file (string): output image, image recorded before is kept if None
+            name (string): name of extent in count series
+        '''
+        state = self.state(extent, name)
+        extent_dir = self.extent_dir(extent)
+        os.makedirs(extent_dir, exist_ok=True)
+        files = {}
+        for map_type, store in detections.items():
+            files[map_type] = re.sub('[^-a-zA-Z0-9_.]+', '_', f"{metadata.sceneId}_{map_type}") + ".npz"
+            store.save(os.path.join(extent_dir, files[map_type]))
+        with self.lock:
+            if name is not None:
+                state["name"] = name
+            scene = state["scenes"].setdefault(metadata.sceneId, {"counts": {}, "detections": {}, "image": None})
+            scene["datetime"] = metadata.datetime
+            scene["satellite"] = metadata.satellite
+            scene["counts"].update({map_type: len(store) for map_type, store in detections.items()})
+            scene["detections"].update(files)
+            if img_file is not None:
+                scene["image"] = img_file
+            state["failed"].pop(metadata.sceneId, None)
+        self.save_state(extent)
+
+    def record_failure(self, extent, metadata):
+        '''
+        Record scene whose jobs failed, watermark does not move past it so it is searched again
+        '''
+        state = self.state(extent)
+        with self.lock:
+            state["failed"][metadata.sceneId] = metadata.datetime
+        self.save_state(extent)
+
+    def detections(self, extent, sceneId, map_type="cars"):
+        '''
+        Returns: DetectionStore of scene saved by record
+        '''
+        scene = self.state(extent)["scenes"][sceneId]
+        return DetectionStore.load(os.path.join(self.extent_dir(extent), scene["detections"][map_type]))
+
+    def series(self, extents):
+        '''
+        Count series of extents sorted by datetime
+        Args:
+            extents (dict): name -> extent
+        Returns: tuple (list of column names, list of rows)
+        '''
+        rows = []
+        map_types = []
+        for name, extent in extents.items():
+            for sceneId, scene in self.state(extent, name)["scenes"].items():
+                for map_type in scene["counts"]:
+                    if map_type not in map_types:
+                        map_types.append(map_type)
+                rows.append((scene["datetime"], name, sceneId, scene["satellite"], scene["counts"]))
+        rows.sort(key=lambda row: (row[0], row[1]))
+        columns = ["datetime", "extent", "sceneId", "satellite"] + map_types
+        return columns, [list(row[:4]) + [row[4].get(map_type) for map_type in map_types] for row in rows]
+
+    def save_series(self, path, extents):
+        '''
+        Save count series to CSV, or to Parquet if path ends with .parquet (requires pyarrow)
+        '''
+        columns, rows = self.series(extents)
+        if path.endswith(".parquet"):
+            import pyarrow
+            import pyarrow.parquet
+            table = pyarrow.table({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+            pyarrow.parquet.write_table(table, path)
+            return
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)